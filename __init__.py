@@ -13,11 +13,14 @@ bl_info = {
 
 import bpy
 from bpy.types import (Panel, Operator, PropertyGroup)
-from bpy.props import (EnumProperty, BoolProperty, PointerProperty)
+from bpy.props import (EnumProperty, BoolProperty, IntProperty, PointerProperty)
 import os
 import subprocess
 import sys
 import importlib
+import concurrent.futures
+import queue
+import threading
 from collections import namedtuple
 import addon_utils
 
@@ -101,6 +104,10 @@ class DeepBumpProperties(PropertyGroup):
                ('LARGE', 'Large', 'Large overlap between tiles')],
         default='LARGE'
     )
+    colortonormals_seamless_bool: BoolProperty(
+        description='If input color map is seamless, enable to get a seamless normal map',
+        default=False
+    )
 
     # Normals -> Height panel props
     normalstoheight_seamless_bool: BoolProperty(
@@ -137,12 +144,73 @@ class DeepBumpProperties(PropertyGroup):
 # ------------------------------------------------------------------------
 
 
-class DEEPBUMP_OT_ColorToNormalsOperator(Operator):
-    bl_idname = 'deepbump.colortonormals'
-    bl_label = 'DeepBump Color → Normals'
-    bl_description = bl_label
-    
-    progress_started = False
+# Outputs & intermediate results of the current session, created on first use
+result_cache = None
+
+
+def get_result_cache(context):
+    global result_cache
+    max_size = context.preferences.addons[__name__].preferences.cache_size * 2**20
+    if result_cache is None:
+        result_cache = utils_cache.LRUCache(max_size)
+    else:
+        result_cache.resize(max_size)
+    return result_cache
+
+
+class DeepBumpTool:
+    """Base of the DeepBump tools, shared by the single node & batch operators.
+    Sub-classes implement 'prepare' (reads settings), 'compute' (numpy processing, called
+    from worker threads) & 'finish' (creates the output image & nodes).
+
+    Outputs are cached for the session, keyed by image datablock name, pixels hash &
+    'cache_options', so that re-running a tool on an unchanged image is instant. 'compute'
+    can also cache intermediate results, under keys starting with the given 'input_key'.
+    Tools with 'supports_preview' give progressive previews to 'preview_callback'."""
+
+    supports_preview = False
+
+    def check_input(self, input_bl_img):
+        """Returns a warning message if the given image cannot be processed."""
+
+        if input_bl_img is None:
+            return 'Selected image node must have an image assigned to it.'
+        return None
+
+    def prepare(self, context):
+        pass
+
+    def cache_options(self):
+        """Returns the settings read by 'prepare', as a tuple."""
+        return ()
+
+    def compute(self, input_img, input_key, progress_callback, preview_callback=None):
+        raise NotImplementedError
+
+    def cached_compute(self, image_name, input_img, progress_callback, preview_callback=None):
+        """Returns the cached output for the input image, calling 'compute' if needed."""
+
+        input_key = (image_name, utils_cache.pixels_hash(input_img))
+        key = input_key + (self.bl_label,) + self.cache_options()
+        output_img = self.cache.get(key)
+        if output_img is not None:
+            print(f'{self.bl_label} : using cached result')
+            return output_img
+        return self.cache.put(
+            key, self.compute(input_img, input_key, progress_callback, preview_callback))
+
+    def finish(self, material, input_node, output_img):
+        """Creates the output image & nodes, returns the output image."""
+        raise NotImplementedError
+
+
+class DeepBumpOperator(DeepBumpTool, Operator):
+    """Base of the DeepBump single node operators. When run from the UI, the processing
+    runs on a worker thread so that Blender stays responsive, progress being sent through
+    a queue polled by a timer. Esc cancels the processing (on its next progress update).
+
+    For tools supporting previews, the outputs are created with the first preview & their
+    pixels updated as it is refined (they are removed if the processing does not end)."""
 
     @classmethod
     def poll(self, context):
@@ -155,27 +223,317 @@ class DEEPBUMP_OT_ColorToNormalsOperator(Operator):
         wm = bpy.context.window_manager
         if self.progress_started:
             wm.progress_update(current)
-            print(f'DeepBump Color → Normals : {current}/{total}')
+            print(f'{self.bl_label} : {current}/{total}')
         else:
             wm.progress_begin(0, total)
             self.progress_started = True
 
+    def start(self, context):
+        """Gets the input image from the selected node & converts it to a numpy C,H,W
+        array. Returns None if it cannot be processed."""
+
+        self.material = context.material
+        self.input_node_name = context.active_node.name
+        warning = self.check_input(context.active_node.image)
+        if warning is not None:
+            self.report({'WARNING'}, warning)
+            return None
+
+        self.prepare(context)
+        self.cache = get_result_cache(context)
+        self.image_name = context.active_node.image.name
+        self.progress_started = False
+        self.preview_bl_img = None
+        return utils.bl_image_to_np(context.active_node.image)
+
+    def end(self, context, output_img):
+        """Creates the outputs once the processing is done."""
+
+        context.window_manager.progress_end()
+        if self.preview_bl_img is not None:
+            # Outputs were created by the first preview
+            utils.np_to_bl_image(output_img, self.preview_bl_img)
+            self.preview_bl_img.update()
+            print(f'{self.bl_label} : done')
+            return {'FINISHED'}
+        input_node = self.material.node_tree.nodes.get(self.input_node_name)
+        if input_node is None:
+            self.report({'WARNING'}, 'Selected image node was removed during processing.')
+            return {'CANCELLED'}
+        self.finish(self.material, input_node, output_img)
+        print(f'{self.bl_label} : done')
+        return {'FINISHED'}
+
     def execute(self, context):
-         # Get input image from selected node
-        input_node = context.active_node
-        input_bl_img = input_node.image
-        if input_bl_img is None:
-            self.report(
-                {'WARNING'}, 'Selected image node must have an image assigned to it.')
+        # Blocking processing (e.g. when called from scripts)
+        input_img = self.start(context)
+        if input_img is None:
+            return {'CANCELLED'}
+        output_img = self.cached_compute(self.image_name, input_img, self.progress_print)
+        return self.end(context, output_img)
+
+    def invoke(self, context, event):
+        input_img = self.start(context)
+        if input_img is None:
+            return {'CANCELLED'}
+
+        # Process on a worker thread
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.preview_event = threading.Event()
+        self.preview_img = None
+        self.worker = threading.Thread(target=self.run, args=(input_img,), daemon=True)
+        self.worker.start()
+
+        # Poll worker progress
+        wm = context.window_manager
+        self.timer = wm.event_timer_add(0.1, window=context.window)
+        wm.modal_handler_add(self)
+        print(f'{self.bl_label} : running (press Esc to cancel)')
+        return {'RUNNING_MODAL'}
+
+    def run(self, input_img):
+        """Worker thread processing, results are sent to the events queue."""
+
+        def progress_callback(current, total):
+            if self.cancel_event.is_set():
+                raise utils_inference.Cancelled()
+            self.events.put(('PROGRESS', current, total))
+
+        # Previews are refined in place, only keep a reference (partially refined pixels
+        # being read is harmless)
+        def preview_callback(preview_img):
+            self.preview_img = preview_img
+            self.preview_event.set()
+
+        try:
+            output_img = self.cached_compute(
+                self.image_name, input_img, progress_callback,
+                preview_callback if self.supports_preview else None)
+            self.events.put(('DONE', output_img))
+        except utils_inference.Cancelled:
+            self.events.put(('CANCELLED',))
+        except Exception as err:
+            self.events.put(('ERROR', str(err)))
+
+    def update_preview(self):
+        """Creates the outputs from the latest preview, or updates their pixels."""
+
+        self.preview_event.clear()
+        if self.preview_bl_img is not None:
+            utils.np_to_bl_image(self.preview_img, self.preview_bl_img)
+            self.preview_bl_img.update()
+            return
+        nodes = self.material.node_tree.nodes
+        input_node = nodes.get(self.input_node_name)
+        if input_node is None:
+            return
+        nodes_before = {node.name for node in nodes}
+        self.preview_bl_img = self.finish(self.material, input_node, self.preview_img)
+        self.preview_nodes = [node.name for node in nodes if node.name not in nodes_before]
+
+    def remove_preview(self):
+        """Removes the outputs created from previews."""
+
+        if self.preview_bl_img is None:
+            return
+        nodes = self.material.node_tree.nodes
+        for node_name in self.preview_nodes:
+            node = nodes.get(node_name)
+            if node is not None:
+                nodes.remove(node)
+        bpy.data.images.remove(self.preview_bl_img)
+        self.preview_bl_img = None
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.cancel_event.set()
+            return {'RUNNING_MODAL'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        if self.preview_event.is_set():
+            self.update_preview()
+
+        while not self.events.empty():
+            message = self.events.get()
+            if message[0] == 'PROGRESS':
+                self.progress_print(*message[1:])
+                continue
+
+            context.window_manager.event_timer_remove(self.timer)
+            if message[0] == 'DONE':
+                return self.end(context, message[1])
+            context.window_manager.progress_end()
+            self.remove_preview()
+            if message[0] == 'CANCELLED':
+                self.report({'INFO'}, f'{self.bl_label} : cancelled')
+            else:
+                self.report({'ERROR'}, f'{self.bl_label} : {message[1]}')
+            return {'CANCELLED'}
+
+        return {'PASS_THROUGH'}
+
+
+# Worker threads shared by all batch operators (ONNX sessions are shared too, each model
+# being loaded only once)
+batch_executor = None
+batch_executor_workers = 0
+
+
+def get_batch_executor(context):
+    global batch_executor, batch_executor_workers
+    workers = context.preferences.addons[__name__].preferences.batch_workers
+    if batch_executor is None or batch_executor_workers != workers:
+        if batch_executor is not None:
+            batch_executor.shutdown(wait=False)
+        batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        batch_executor_workers = workers
+    return batch_executor, workers
+
+
+class DeepBumpBatchOperator(DeepBumpTool, Operator):
+    """Base of the DeepBump batch operators, processing all the selected image nodes or all
+    the image nodes of the material or scene. Images are processed in parallel by the
+    batch worker threads, Esc cancels the remaining ones."""
+
+    scope: EnumProperty(
+        name='Scope',
+        items=[('SELECTED', 'Selected nodes', 'All selected image nodes'),
+               ('MATERIAL', 'Material', 'All image nodes of the material'),
+               ('SCENE', 'Scene', 'All image nodes of the scene materials')],
+        default='SELECTED'
+    )
+
+    @classmethod
+    def poll(self, context):
+        return context.area.type == 'NODE_EDITOR' and context.material is not None
+
+    def collect_nodes(self, context):
+        """Returns the (material, image node name) pairs to process, only keeping one node
+        per image."""
+
+        if self.scope == 'SCENE':
+            materials = {slot.material for obj in context.scene.objects
+                         for slot in obj.material_slots
+                         if slot.material is not None and slot.material.use_nodes}
+        else:
+            materials = [context.material]
+
+        nodes = []
+        images = set()
+        for material in sorted(materials, key=lambda material: material.name):
+            for node in material.node_tree.nodes:
+                if node.bl_idname != 'ShaderNodeTexImage':
+                    continue
+                if self.scope == 'SELECTED' and not node.select:
+                    continue
+                if self.check_input(node.image) is not None or node.image.name in images:
+                    continue
+                images.add(node.image.name)
+                nodes.append((material, node.name))
+        return nodes
+
+    def execute(self, context):
+        self.prepare(context)
+        self.cache = get_result_cache(context)
+        self.pending = self.collect_nodes(context)
+        if len(self.pending) == 0:
+            self.report({'WARNING'}, 'No image node to process.')
             return {'CANCELLED'}
 
-        # Convert image to numpy C,H,W array
-        input_img = utils.bl_image_to_np(input_bl_img)
+        self.executor, self.workers = get_batch_executor(context)
+        self.running = {}
+        self.cancel_event = threading.Event()
+        self.total = len(self.pending)
+        self.done = 0
+
+        wm = context.window_manager
+        wm.progress_begin(0, self.total)
+        self.timer = wm.event_timer_add(0.1, window=context.window)
+        wm.modal_handler_add(self)
+        print(f'{self.bl_label} : {self.total} images (press Esc to cancel)')
+        return {'RUNNING_MODAL'}
+
+    def run(self, image_name, input_img):
+        """Worker thread processing."""
+
+        def progress_callback(current, total):
+            if self.cancel_event.is_set():
+                raise utils_inference.Cancelled()
+
+        return self.cached_compute(image_name, input_img, progress_callback)
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.cancel_event.set()
+            self.pending = []
+            return {'RUNNING_MODAL'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        # Create outputs of finished images (on the main thread)
+        for future, (material, node_name) in list(self.running.items()):
+            if not future.done():
+                continue
+            del self.running[future]
+            self.done += 1
+            context.window_manager.progress_update(self.done)
+            try:
+                output_img = future.result()
+            except utils_inference.Cancelled:
+                continue
+            except Exception as err:
+                self.report({'ERROR'}, f'{self.bl_label} : {node_name} : {err}')
+                continue
+            input_node = material.node_tree.nodes.get(node_name)
+            if input_node is not None:
+                self.finish(material, input_node, output_img)
+                print(f'{self.bl_label} : {self.done}/{self.total} {input_node.image.name}')
+
+        # Only read pixels of the images about to be processed, to bound memory use
+        while self.pending and len(self.running) < self.workers:
+            material, node_name = self.pending.pop(0)
+            input_node = material.node_tree.nodes.get(node_name)
+            if input_node is None or input_node.image is None:
+                self.done += 1
+                continue
+            input_img = utils.bl_image_to_np(input_node.image)
+            future = self.executor.submit(self.run, input_node.image.name, input_img)
+            self.running[future] = (material, node_name)
+
+        if self.running:
+            return {'PASS_THROUGH'}
+
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        if self.cancel_event.is_set():
+            self.report({'INFO'}, f'{self.bl_label} : cancelled')
+            return {'CANCELLED'}
+        print(f'{self.bl_label} : done')
+        return {'FINISHED'}
+
 
+class ColorToNormalsTool(DeepBumpTool):
+    bl_label = 'DeepBump Color → Normals'
+    supports_preview = True
+
+    def prepare(self, context):
+        self.overlap = context.scene.deep_bump_tool.colortonormals_tiles_overlap_enum
+        self.seamless = context.scene.deep_bump_tool.colortonormals_seamless_bool
+
+    def cache_options(self):
+        return (self.overlap, self.seamless)
+
+    def compute(self, input_img, input_key, progress_callback, preview_callback=None):
         # Compute normals
-        OVERLAP = context.scene.deep_bump_tool.colortonormals_tiles_overlap_enum
-        self.progress_started = False
-        output_img = module_color_to_normals.apply(input_img, OVERLAP, self.progress_print)
+        return module_color_to_normals.apply(input_img, self.overlap, progress_callback,
+                                             preview_callback=preview_callback,
+                                             seamless=self.seamless)
+
+    def finish(self, material, input_node, output_img):
+        input_bl_img = input_node.image
 
         # Create new image datablock
         input_img_name = os.path.splitext(input_bl_img.name)
@@ -185,21 +543,21 @@ class DEEPBUMP_OT_ColorToNormalsOperator(Operator):
         output_bl_img.colorspace_settings.name = 'Non-Color'
 
         # Convert numpy C,H,W array back to blender image pixels
-        output_bl_img.pixels = utils.np_to_bl_pixels(output_img)
+        utils.np_to_bl_image(output_img, output_bl_img)
 
         # Create new node for normal map
-        output_node = context.material.node_tree.nodes.new(
+        output_node = material.node_tree.nodes.new(
             type='ShaderNodeTexImage')
         output_node.location = input_node.location
         output_node.location[1] -= input_node.width*1.2
         output_node.image = output_bl_img
 
         # Create normal vector node & link nodes
-        normal_vec_node = context.material.node_tree.nodes.new(
+        normal_vec_node = material.node_tree.nodes.new(
             type='ShaderNodeNormalMap')
         normal_vec_node.location = output_node.location
         normal_vec_node.location[0] += output_node.width*1.1
-        links = context.material.node_tree.links
+        links = material.node_tree.links
         links.new(output_node.outputs['Color'],
                   normal_vec_node.inputs['Color'])
 
@@ -211,54 +569,36 @@ class DEEPBUMP_OT_ColorToNormalsOperator(Operator):
                     links.new(
                         normal_vec_node.outputs['Normal'], to_node.inputs['Normal'])
 
-        print('DeepBump Color → Normals : done')
-        return {'FINISHED'}
+        return output_bl_img
 
 
-class DEEPBUMP_OT_NormalsToHeightOperator(Operator):
-    bl_idname = 'deepbump.normalstoheight'
+class NormalsToHeightTool(DeepBumpTool):
     bl_label = 'DeepBump Normals → Height'
-    bl_description = bl_label
 
-    progress_started = False
+    def check_input(self, input_bl_img):
+        if input_bl_img is not None and input_bl_img.colorspace_settings.name != 'Non-Color':
+            return 'Selected image node must be a normal map in Non-Color colorspace.'
+        return super().check_input(input_bl_img)
 
-    @classmethod
-    def poll(self, context):
-        if context.active_node is not None :
-            selected_node_type = context.active_node.bl_idname
-            return (context.area.type == 'NODE_EDITOR') and (selected_node_type == 'ShaderNodeTexImage')
-        return False
-
-    def progress_print(self, current, total):
-        wm = bpy.context.window_manager
-        if self.progress_started:
-            wm.progress_update(current)
-            print(f'DeepBump Normals → Height : {current}/{total}')
-        else:
-            wm.progress_begin(0, total)
-            self.progress_started = True
-
-    def execute(self, context):
-        # Get input image from selected node
-        input_node = context.active_node
-        input_bl_img = input_node.image
-        if input_bl_img is None:
-            self.report(
-                {'WARNING'}, 'Selected image node must have an image assigned to it.')
-            return {'CANCELLED'}
-        if input_bl_img.colorspace_settings.name != 'Non-Color':
-            self.report(
-                {'WARNING'}, 'Selected image node must be a normal map in Non-Color colorspace.')
-            return {'CANCELLED'}
+    def prepare(self, context):
+        self.seamless = context.scene.deep_bump_tool.normalstoheight_seamless_bool
 
-        # Convert image to numpy C,H,W array
-        input_img = utils.bl_image_to_np(input_bl_img)
+    def cache_options(self):
+        return (self.seamless,)
 
-        # Compute height
+    def compute(self, input_img, input_key, progress_callback, preview_callback=None):
+        # Compute height, keeping the gradients spectra
         print('DeepBump Normals → Height : computing')
-        SEAMLESS = context.scene.deep_bump_tool.normalstoheight_seamless_bool
-        self.progress_started = False
-        output_img = module_normals_to_height.apply(input_img, SEAMLESS, self.progress_print)
+        spectra_key = input_key + ('gradients_spectra', self.seamless)
+        spectra = self.cache.get(spectra_key)
+        if spectra is None:
+            spectra = self.cache.put(spectra_key, module_normals_to_height.gradients_spectra(
+                input_img, self.seamless, progress_callback))
+        return module_normals_to_height.spectra_to_height(
+            *spectra, input_img.shape, self.seamless, progress_callback)
+
+    def finish(self, material, input_node, output_img):
+        input_bl_img = input_node.image
 
         # Create new image datablock
         input_img_name = os.path.splitext(input_bl_img.name)
@@ -268,63 +608,45 @@ class DEEPBUMP_OT_NormalsToHeightOperator(Operator):
         output_bl_img.colorspace_settings.name = 'Non-Color'
 
         # Convert numpy C,H,W array back to blender imaga pixels
-        output_bl_img.pixels = utils.np_to_bl_pixels(output_img)
+        utils.np_to_bl_image(output_img, output_bl_img)
 
         # Create new node for curvature map
-        output_node = context.material.node_tree.nodes.new(
+        output_node = material.node_tree.nodes.new(
             type='ShaderNodeTexImage')
         output_node.location = input_node.location
         output_node.location[1] -= input_node.width*1.2
         output_node.image = output_bl_img
 
-        print('DeepBump Normals → Height : done')
-        return {'FINISHED'}
+        return output_bl_img
 
 
-class DEEPBUMP_OT_NormalsToCurvatureOperator(Operator):
-    bl_idname = 'deepbump.normalstocurvature'
+class NormalsToCurvatureTool(DeepBumpTool):
     bl_label = 'DeepBump Normals → Curvature'
-    bl_description = bl_label
-    
-    progress_started = False
 
-    @classmethod
-    def poll(self, context):
-        if context.active_node is not None :
-            selected_node_type = context.active_node.bl_idname
-            return (context.area.type == 'NODE_EDITOR') and (selected_node_type == 'ShaderNodeTexImage')
-        return False
-
-    def progress_print(self, current, total):
-        wm = bpy.context.window_manager
-        if self.progress_started:
-            wm.progress_update(current)
-            print(f'DeepBump Normals → Curvature : {current}/{total}')
-        else:
-            wm.progress_begin(0, total)
-            self.progress_started = True
+    def check_input(self, input_bl_img):
+        if input_bl_img is not None and input_bl_img.colorspace_settings.name != 'Non-Color':
+            return 'Selected image node must be a normal map in Non-Color colorspace.'
+        return super().check_input(input_bl_img)
 
-    def execute(self, context):
-        # Get input image from selected node
-        input_node = context.active_node
-        input_bl_img = input_node.image
-        if input_bl_img is None:
-            self.report(
-                {'WARNING'}, 'Selected image node must have an image assigned to it.')
-            return {'CANCELLED'}
-        if input_bl_img.colorspace_settings.name != 'Non-Color':
-            self.report(
-                {'WARNING'}, 'Selected image node must be a normal map in Non-Color colorspace.')
-            return {'CANCELLED'}
+    def prepare(self, context):
+        self.blur_radius = context.scene.deep_bump_tool.normalstocurvature_blur_radius_enum
 
-        # Convert image to numpy C,H,W array
-        input_img = utils.bl_image_to_np(input_bl_img)
+    def cache_options(self):
+        return (self.blur_radius,)
 
-        # Compute curvature
+    def compute(self, input_img, input_key, progress_callback, preview_callback=None):
+        # Compute curvature, keeping the edges (they do not depend on the blur radius)
         print('DeepBump Normals → Curvature : computing')
-        BLUR_RADIUS = context.scene.deep_bump_tool.normalstocurvature_blur_radius_enum
-        self.progress_started = False
-        output_img = module_normals_to_curvature.apply(input_img, BLUR_RADIUS, self.progress_print)
+        edges_key = input_key + ('edges',)
+        edges = self.cache.get(edges_key)
+        if edges is None:
+            edges = self.cache.put(edges_key, module_normals_to_curvature.edges(
+                input_img, progress_callback))
+        return module_normals_to_curvature.edges_to_curvature(
+            edges, input_img.shape, self.blur_radius, progress_callback)
+
+    def finish(self, material, input_node, output_img):
+        input_bl_img = input_node.image
 
         # Create new image datablock
         input_img_name = os.path.splitext(input_bl_img.name)
@@ -334,73 +656,48 @@ class DEEPBUMP_OT_NormalsToCurvatureOperator(Operator):
         output_bl_img.colorspace_settings.name = 'Non-Color'
 
         # Convert numpy C,H,W array back to blender imaga pixels
-        output_bl_img.pixels = utils.np_to_bl_pixels(output_img)
+        utils.np_to_bl_image(output_img, output_bl_img)
 
         # Create new node for curvature map
-        output_node = context.material.node_tree.nodes.new(
+        output_node = material.node_tree.nodes.new(
             type='ShaderNodeTexImage')
         output_node.location = input_node.location
         output_node.location[1] -= input_node.width*1.2
         output_node.image = output_bl_img
 
-        print('DeepBump Normals → Curvature : done')
-        return {'FINISHED'}
+        return output_bl_img
 
 
-class DEEPBUMP_OT_LowresToHighresOperator(Operator):
-    bl_idname = 'deepbump.lowrestohighres'
+class LowresToHighresTool(DeepBumpTool):
     bl_label = 'DeepBump Low Res → High Res'
-    bl_description = bl_label
-    
-    progress_started = False
-
-    @classmethod
-    def poll(self, context):
-        if context.active_node is not None :
-            selected_node_type = context.active_node.bl_idname
-            return (context.area.type == 'NODE_EDITOR') and (selected_node_type == 'ShaderNodeTexImage')
-        return False
-
-    def progress_print(self, current, total):
-        wm = bpy.context.window_manager
-        if self.progress_started:
-            wm.progress_update(current)
-            print(f'DeepBump Low Res → High Res : {current}/{total}')
-        else:
-            wm.progress_begin(0, total)
-            self.progress_started = True
 
-    def execute(self, context):
-         # Get input image from selected node
-        input_node = context.active_node
-        input_bl_img = input_node.image
-        if input_bl_img is None:
-            self.report(
-                {'WARNING'}, 'Selected image node must have an image assigned to it.')
-            return {'CANCELLED'}
+    def prepare(self, context):
+        self.scale_factor = context.scene.deep_bump_tool.lowrestohighres_scale_factor_enum
 
-        # Convert image to numpy C,H,W array
-        input_img = utils.bl_image_to_np(input_bl_img)
+    def cache_options(self):
+        return (self.scale_factor,)
 
+    def compute(self, input_img, input_key, progress_callback, preview_callback=None):
         # Compute upscaled image
-        self.progress_started = False
-        SCALE_FACTOR = context.scene.deep_bump_tool.lowrestohighres_scale_factor_enum
-        output_img = module_lowres_to_highres.apply(input_img, SCALE_FACTOR, self.progress_print)
+        return module_lowres_to_highres.apply(input_img, self.scale_factor, progress_callback)
+
+    def finish(self, material, input_node, output_img):
+        input_bl_img = input_node.image
 
         # Create new image datablock
         input_img_name = os.path.splitext(input_bl_img.name)
         output_img_name = input_img_name[0] + '_highres' + input_img_name[1]
-        upscale_factor = int(SCALE_FACTOR[1:])
+        upscale_factor = int(self.scale_factor[1:])
         output_bl_img = bpy.data.images.new(
             output_img_name, width=input_bl_img.size[0] * upscale_factor, 
             height=input_bl_img.size[1] * upscale_factor)
         output_bl_img.colorspace_settings.name = input_bl_img.colorspace_settings.name
 
         # Convert numpy C,H,W array back to blender image pixels
-        output_bl_img.pixels = utils.np_to_bl_pixels(output_img)
+        utils.np_to_bl_image(output_img, output_bl_img)
 
         # Create new node for the upscaled image
-        output_node = context.material.node_tree.nodes.new(
+        output_node = material.node_tree.nodes.new(
             type='ShaderNodeTexImage')
         output_node.location = input_node.location
         output_node.location[1] -= input_node.width*1.2
@@ -411,12 +708,59 @@ class DEEPBUMP_OT_LowresToHighresOperator(Operator):
             if len(input_node.outputs['Color'].links) == 1:
                 to_node = input_node.outputs['Color'].links[0].to_node
                 if to_node.bl_idname == 'ShaderNodeBsdfPrincipled':
-                    links = context.material.node_tree.links
+                    links = material.node_tree.links
                     links.new(
                         output_node.outputs['Color'], to_node.inputs['Base Color'])
 
-        print('DeepBump Low Res → High Res : done')
-        return {'FINISHED'}
+        return output_bl_img
+
+
+class DEEPBUMP_OT_ColorToNormalsOperator(ColorToNormalsTool, DeepBumpOperator):
+    bl_idname = 'deepbump.colortonormals'
+    bl_label = ColorToNormalsTool.bl_label
+    bl_description = bl_label
+
+
+class DEEPBUMP_OT_ColorToNormalsBatchOperator(ColorToNormalsTool, DeepBumpBatchOperator):
+    bl_idname = 'deepbump.colortonormals_batch'
+    bl_label = ColorToNormalsTool.bl_label
+    bl_description = bl_label + ' (batch)'
+
+
+class DEEPBUMP_OT_NormalsToHeightOperator(NormalsToHeightTool, DeepBumpOperator):
+    bl_idname = 'deepbump.normalstoheight'
+    bl_label = NormalsToHeightTool.bl_label
+    bl_description = bl_label
+
+
+class DEEPBUMP_OT_NormalsToHeightBatchOperator(NormalsToHeightTool, DeepBumpBatchOperator):
+    bl_idname = 'deepbump.normalstoheight_batch'
+    bl_label = NormalsToHeightTool.bl_label
+    bl_description = bl_label + ' (batch)'
+
+
+class DEEPBUMP_OT_NormalsToCurvatureOperator(NormalsToCurvatureTool, DeepBumpOperator):
+    bl_idname = 'deepbump.normalstocurvature'
+    bl_label = NormalsToCurvatureTool.bl_label
+    bl_description = bl_label
+
+
+class DEEPBUMP_OT_NormalsToCurvatureBatchOperator(NormalsToCurvatureTool, DeepBumpBatchOperator):
+    bl_idname = 'deepbump.normalstocurvature_batch'
+    bl_label = NormalsToCurvatureTool.bl_label
+    bl_description = bl_label + ' (batch)'
+
+
+class DEEPBUMP_OT_LowresToHighresOperator(LowresToHighresTool, DeepBumpOperator):
+    bl_idname = 'deepbump.lowrestohighres'
+    bl_label = LowresToHighresTool.bl_label
+    bl_description = bl_label
+
+
+class DEEPBUMP_OT_LowresToHighresBatchOperator(LowresToHighresTool, DeepBumpBatchOperator):
+    bl_idname = 'deepbump.lowrestohighres_batch'
+    bl_label = LowresToHighresTool.bl_label
+    bl_description = bl_label + ' (batch)'
 
 
 class DEEPBUMP_OT_install_dependencies(bpy.types.Operator):
@@ -473,7 +817,9 @@ class DEEPBUMP_PT_ColorToNormalsPanel(Panel):
         row = layout.row()
         row.label(text='Tiles overlap')
         row.prop(deep_bump_tool, 'colortonormals_tiles_overlap_enum', text='')
+        layout.prop(deep_bump_tool, 'colortonormals_seamless_bool', text='Seamless color')
         layout.operator('deepbump.colortonormals', text='Generate Normal Map')
+        layout.operator_menu_enum('deepbump.colortonormals_batch', 'scope', text='Generate Normal Map (batch)')
 
 
 class DEEPBUMP_PT_NormalsToHeightPanel(Panel):
@@ -493,6 +839,7 @@ class DEEPBUMP_PT_NormalsToHeightPanel(Panel):
         deep_bump_tool = context.scene.deep_bump_tool
         layout.prop(deep_bump_tool, 'normalstoheight_seamless_bool', text='Seamless normals')
         layout.operator('deepbump.normalstoheight', text='Generate Height Map')
+        layout.operator_menu_enum('deepbump.normalstoheight_batch', 'scope', text='Generate Height Map (batch)')
 
 
 class DEEPBUMP_PT_NormalsToCurvaturePanel(Panel):
@@ -514,6 +861,7 @@ class DEEPBUMP_PT_NormalsToCurvaturePanel(Panel):
         row.label(text='Blur radius')
         row.prop(deep_bump_tool, 'normalstocurvature_blur_radius_enum', text='')
         layout.operator('deepbump.normalstocurvature', text='Generate Curvature Map')
+        layout.operator_menu_enum('deepbump.normalstocurvature_batch', 'scope', text='Generate Curvature Map (batch)')
 
 class DEEPBUMP_PT_LowresToHighresPanel(Panel):
     bl_idname = 'DEEPBUMP_PT_LowresToHighresPanel'
@@ -534,16 +882,35 @@ class DEEPBUMP_PT_LowresToHighresPanel(Panel):
         row.label(text='Scale factor')
         row.prop(deep_bump_tool, 'lowrestohighres_scale_factor_enum', text='')
         layout.operator('deepbump.lowrestohighres', text='Upscale')
+        layout.operator_menu_enum('deepbump.lowrestohighres_batch', 'scope', text='Upscale (batch)')
 
 
 class DEEPBUMP_preferences(bpy.types.AddonPreferences):
     bl_idname = __name__
 
+    batch_workers: IntProperty(
+        name='Batch workers',
+        description='Amount of images processed in parallel by batch operators',
+        default=2,
+        min=1,
+        max=64
+    )
+
+    cache_size: IntProperty(
+        name='Cache size (MB)',
+        description='Memory used to keep results of the session, so that re-running a tool '
+                    'on an unchanged image (or with other settings) is faster. 0 disables the cache',
+        default=1024,
+        min=0
+    )
+
     def draw(self, context):
         layout = self.layout
         if dependencies_installed :
             layout.label(text='Required dependencies are installed', icon='CHECKMARK')
             layout.label(text=f'(Dependencies path : {get_dependencies_path()})')
+            layout.prop(self, 'batch_workers')
+            layout.prop(self, 'cache_size')
         else :
             layout.label(text='Installing dependencies requires internet and might take a few minutes', 
                          icon='INFO')
@@ -558,17 +925,21 @@ class DEEPBUMP_preferences(bpy.types.AddonPreferences):
 # Classes for the addon actual functionality
 classes = (
     DeepBumpProperties,
-    # Color -> Normals operator & panel
+    # Color -> Normals operators & panel
     DEEPBUMP_OT_ColorToNormalsOperator,
+    DEEPBUMP_OT_ColorToNormalsBatchOperator,
     DEEPBUMP_PT_ColorToNormalsPanel,
-    # Normals -> Height operator & panel
+    # Normals -> Height operators & panel
     DEEPBUMP_OT_NormalsToHeightOperator,
+    DEEPBUMP_OT_NormalsToHeightBatchOperator,
     DEEPBUMP_PT_NormalsToHeightPanel,
-    # Normals -> Curvature operator & panel
+    # Normals -> Curvature operators & panel
     DEEPBUMP_OT_NormalsToCurvatureOperator,
+    DEEPBUMP_OT_NormalsToCurvatureBatchOperator,
     DEEPBUMP_PT_NormalsToCurvaturePanel,
-    # Low res -> High res operator & panel
+    # Low res -> High res operators & panel
     DEEPBUMP_OT_LowresToHighresOperator,
+    DEEPBUMP_OT_LowresToHighresBatchOperator,
     DEEPBUMP_PT_LowresToHighresPanel
 )
 # Classes for downloading & installing dependencies
@@ -606,6 +977,8 @@ def register_functionality():
     from . import module_normals_to_curvature
     from . import module_lowres_to_highres
     from . import utils
+    from . import utils_inference
+    from . import utils_cache
 
 
 def unregister():
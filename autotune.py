@@ -0,0 +1,103 @@
+import os
+import platform
+import time
+import numpy as np
+import module_color_to_normals
+import module_lowres_to_highres
+import utils_inference
+import utils_profile
+
+# Models to tune & the shape of their input tiles
+MODELS = [
+    (module_color_to_normals.model_path, (1, 256, 256)),
+    (module_lowres_to_highres.model_path, (3, 256, 256)),
+]
+
+BATCH_SIZES = [1, 2, 4, 8, 16]
+
+# Messages of the ONNX Runtime errors ending the batch size search : the model does not
+# support batches (fixed batch dimension) or they do not fit in memory
+BATCH_SIZE_ERRORS = ["invalid dimensions", "failed to allocate"]
+
+
+def thread_counts(cpu_count):
+    """Returns the intra-op thread counts to try."""
+
+    return sorted({1, max(1, cpu_count // 4), max(1, cpu_count // 2), cpu_count})
+
+
+def is_batch_size_error(err):
+    """Returns True if 'err' (raised by a model run) means the batch size is too big for
+    the model or the memory, other errors being real failures."""
+
+    if isinstance(err, MemoryError):
+        return True
+    message = str(err).lower()
+    return any(pattern in message for pattern in BATCH_SIZE_ERRORS)
+
+
+def benchmark(ort_session, tile_shape, batch_size, min_time):
+    """Returns the tiles per second of the model on synthetic tiles, timing batches for at
+    least 'min_time' seconds (after a warm up batch)."""
+
+    tiles = np.random.rand(batch_size, *tile_shape).astype(np.float32)
+    utils_inference.tiles_infer(tiles, ort_session, batch_size=batch_size)
+
+    tiles_nb = 0
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < min_time:
+        utils_inference.tiles_infer(tiles, ort_session, batch_size=batch_size)
+        tiles_nb += batch_size
+    return tiles_nb / (time.perf_counter() - start_time)
+
+
+def tune_model(model_path, tile_shape, min_time):
+    """Returns the fastest settings for the model, as a machine profile entry."""
+
+    cpu_count = os.cpu_count()
+    inter_counts = [1, 2] if cpu_count >= 4 else [1]
+    best = None
+    for intra in thread_counts(cpu_count):
+        for inter in inter_counts:
+            tuning = {"intra_op_num_threads": intra, "inter_op_num_threads": inter}
+            ort_session = utils_inference.create_session(model_path, tuning)
+
+            # Bigger batches until they stop helping (or the model does not support them)
+            previous = 0.0
+            for batch_size in BATCH_SIZES:
+                try:
+                    tiles_per_second = benchmark(ort_session, tile_shape, batch_size, min_time)
+                except Exception as err:
+                    if batch_size == 1 or not is_batch_size_error(err):
+                        raise
+                    break
+                print(
+                    f"DeepBump autotune : {os.path.basename(model_path)} intra_op {intra}, "
+                    + f"inter_op {inter}, batch {batch_size} : {tiles_per_second:.2f} tiles/s"
+                )
+                if best is None or tiles_per_second > best["tiles_per_second"]:
+                    best = dict(tuning, batch_size=batch_size, tiles_per_second=tiles_per_second)
+                if tiles_per_second < previous * 1.05:
+                    break
+                previous = tiles_per_second
+    return best
+
+
+def run(min_time=0.5):
+    """Tunes each model on the local CPU & saves the machine profile."""
+
+    profile = {
+        "machine": platform.node(),
+        "cpu_count": os.cpu_count(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "models": {},
+    }
+    for model_path, tile_shape in MODELS:
+        tuning = tune_model(model_path, tile_shape, min_time)
+        if tuning is not None:
+            profile["models"][os.path.basename(model_path)] = tuning
+    path = utils_profile.save_profile(profile)
+    print(f"DeepBump autotune : profile saved to {path}")
+    for model, tuning in profile["models"].items():
+        print(f"DeepBump autotune : {model} : {tuning}")
+    return profile
@@ -0,0 +1,83 @@
+"""Measures the CLI startup time : the wall time of short CLI runs & of importing each
+module in a fresh interpreter, as medians over several runs. Run from anywhere :
+
+    python3 benchmarks/startup.py --runs 25
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules imported by the CLI, from the lightest to the heaviest
+MODULES = [
+    "cli",
+    "utils_io",
+    "module_normals_to_height",
+    "module_normals_to_curvature",
+    "module_normals_to_height_curvature",
+    "module_color_to_normals",
+    "module_lowres_to_highres",
+]
+
+
+def median_time(command, runs):
+    """Returns the median wall time (in seconds) of running 'command' in the repository
+    directory."""
+
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, check=True, capture_output=True)
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+
+def make_input(path, width=96, height=64):
+    """Writes a small flat normal map, so that runs mostly measure the startup."""
+
+    sys.path.insert(0, ROOT)
+    import numpy as np
+    import utils_io
+
+    normals = np.empty((3, height, width), dtype=np.float32)
+    normals[:] = np.array([0.5, 0.5, 1.0], dtype=np.float32)[:, None, None]
+    utils_io.write_image(path, normals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="runs per measurement")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_path = os.path.join(tmp_dir, "normals.png")
+        out_path = os.path.join(tmp_dir, "out.png")
+        make_input(in_path)
+
+        python = [sys.executable]
+        commands = [
+            ("python (baseline)", python + ["-c", "pass"]),
+            ("cli.py -h", python + ["cli.py", "-h"]),
+            ("normals_to_height", python + ["cli.py", in_path, out_path, "normals_to_height"]),
+            (
+                "normals_to_curvature",
+                python + ["cli.py", in_path, out_path, "normals_to_curvature"],
+            ),
+        ]
+        commands += [
+            (f"import {module}", python + ["-c", f"import {module}"]) for module in MODULES
+        ]
+
+        print(f"Median wall time over {args.runs} runs :")
+        for name, command in commands:
+            print(f"  {name:<45} {median_time(command, args.runs):.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,91 +1,829 @@
 import argparse
-import numpy as np
-import imageio.v3 as iio
-import module_color_to_normals
-import module_normals_to_curvature
-import module_normals_to_height
-import module_lowres_to_highres
-
-# Parse CLI args
-parser = argparse.ArgumentParser(description="DeepBump CLI")
-parser.add_argument("in_img_path", help="path to the input image", type=str)
-parser.add_argument("out_img_path", help="path to the output image", type=str)
-parser.add_argument(
-    "module",
-    help="processing to be applied",
-    choices=[
-        "color_to_normals",
-        "normals_to_curvature",
-        "normals_to_height",
-        "lowres_to_highres",
-    ],
-)
-parser.add_argument(
-    "--verbose",
-    action=argparse.BooleanOptionalAction,
-    help="prints progress to the console",
-)
-parser.add_argument(
-    "--color_to_normals-overlap",
-    choices=["SMALL", "MEDIUM", "LARGE"],
-    required=False,
-    default="LARGE",
-)
-parser.add_argument(
-    "--normals_to_curvature-blur_radius",
-    choices=["SMALLEST", "SMALLER", "SMALL", "MEDIUM", "LARGE", "LARGER", "LARGEST"],
-    required=False,
-    default="MEDIUM",
-)
-parser.add_argument(
-    "--normals_to_height-seamless",
-    choices=["TRUE", "FALSE"],
-    required=False,
-    default="FALSE",
-)
-parser.add_argument(
-    "--lowres_to_highres-scale_factor",
-    choices=["x2", "x4"],
-    required=False,
-    default="FALSE",
-)
-args = parser.parse_args()
+import importlib
+import json
+import os
+import time
+
+# Heavier dependencies (numpy, imageio, onnxruntime & the processing modules) are only
+# imported once needed, so that selecting a pure numpy module does not pay for the ML
+# runtime & sending work to the daemon does not pay for any of them.
+
+MODULES = [
+    "color_to_normals",
+    "normals_to_curvature",
+    "normals_to_height",
+    "lowres_to_highres",
+]
+
+# Modules taking a normal map as input. When 'color_to_normals' is part of the
+# same invocation, they consume its output directly from memory.
+NORMALS_MODULES = ["normals_to_curvature", "normals_to_height"]
+
+DEFAULT_DAEMON_ADDRESS = "127.0.0.1:7370"
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="DeepBump CLI")
+    parser.add_argument("in_img_path", help="path to the input image", type=str, nargs="?")
+    parser.add_argument(
+        "out_img_path",
+        help="path to the output image (comma-separated list when several modules are given)",
+        type=str,
+        nargs="?",
+    )
+    parser.add_argument(
+        "module",
+        help="processing to be applied (comma-separated list to chain several modules, e.g. "
+        + "color_to_normals,normals_to_height,normals_to_curvature)",
+        type=str,
+        nargs="?",
+    )
+    parser.add_argument(
+        "--verbose",
+        action=argparse.BooleanOptionalAction,
+        help="prints progress to the console",
+    )
+    parser.add_argument(
+        "--color_to_normals-overlap",
+        choices=["SMALL", "MEDIUM", "LARGE"],
+        required=False,
+        default="LARGE",
+    )
+    parser.add_argument(
+        "--color_to_normals-flat_threshold",
+        help="tiles with a variance below this threshold (e.g. 1e-5) are not inferred but "
+        + "get the normals of a constant tile",
+        type=float,
+    )
+    parser.add_argument(
+        "--color_to_normals-seamless",
+        help="treats the input as a tileable texture : tiles wrap around its borders, "
+        + "giving a seamless normal map",
+        choices=["TRUE", "FALSE"],
+        required=False,
+        default="FALSE",
+    )
+    parser.add_argument(
+        "--normals_to_curvature-blur_radius",
+        choices=["SMALLEST", "SMALLER", "SMALL", "MEDIUM", "LARGE", "LARGER", "LARGEST"],
+        required=False,
+        default="MEDIUM",
+    )
+    parser.add_argument(
+        "--normals_to_height-seamless",
+        choices=["TRUE", "FALSE"],
+        required=False,
+        default="FALSE",
+    )
+    parser.add_argument(
+        "--normals_to_height-mip_levels",
+        help="amount of mip levels written along the height (e.g. height_mip1.png, each "
+        + "half the size of the previous one), computed from the height spectrum",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--lowres_to_highres-scale_factor",
+        choices=["x2", "x4"],
+        required=False,
+        default="FALSE",
+    )
+    parser.add_argument(
+        "--lowres_to_highres-flat_threshold",
+        help="tiles with a variance below this threshold (e.g. 1e-5) are not inferred but "
+        + "get the upscale of a constant tile",
+        type=float,
+    )
+    parser.add_argument(
+        "--bit_depth",
+        help="bits per channel of the output images, 16 bits is supported for PNG & TIFF "
+        + "outputs (.npy outputs are always float32)",
+        type=int,
+        choices=[8, 16],
+        default=8,
+    )
+    parser.add_argument(
+        "--max_memory",
+        help="memory budget (e.g. 4G), modules switch to slower low memory code paths "
+        + "when they would exceed it",
+        type=parse_size,
+    )
+    parser.add_argument(
+        "--ort_mem_arena",
+        action=argparse.BooleanOptionalAction,
+        help="enables/disables the ONNX Runtime CPU memory arena (enabled by default)",
+    )
+    parser.add_argument(
+        "--ort_mem_pattern",
+        action=argparse.BooleanOptionalAction,
+        help="enables/disables the ONNX Runtime memory pattern optimization (enabled by default)",
+    )
+    parser.add_argument(
+        "--ort_threads",
+        help="amount of threads used by ONNX Runtime for each model run (0 for all cores)",
+        type=int,
+    )
+    parser.add_argument(
+        "--batch",
+        action=argparse.BooleanOptionalAction,
+        help="processes all images of the in_img_path directory (and its subdirectories) "
+        + "into the out_img_path directory",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="batch manifest file, inputs already processed with the same settings are skipped",
+        type=str,
+    )
+    parser.add_argument(
+        "--shard",
+        help="only processes the INDEX/COUNT share of the batch (e.g. 0/4 to 3/4 on 4 nodes)",
+        type=str,
+    )
+    parser.add_argument(
+        "--batch_workers",
+        help="amount of worker processes processing batch images in parallel, each keeping "
+        + "its own models loaded",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--report",
+        help="JSON file the batch run report (or merged report) is written to, updated "
+        + "while the run is in progress",
+        type=str,
+    )
+    parser.add_argument(
+        "--prometheus_textfile",
+        help="Prometheus textfile collector file (.prom) the batch run metrics are written "
+        + "to, updated while the run is in progress",
+        type=str,
+    )
+    parser.add_argument(
+        "--merge_manifests",
+        help="merges the given shards manifests into the --manifest file",
+        type=str,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--merge_reports",
+        help="merges the given shards timing reports into the --report file",
+        type=str,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="benchmarks batch sizes & thread counts of each model on this machine & saves "
+        + "the fastest ones to the machine profile, used automatically afterwards",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="runs a local daemon keeping the models loaded, to be used with --daemon",
+    )
+    parser.add_argument(
+        "--daemon",
+        action=argparse.BooleanOptionalAction,
+        help="sends the work to the local daemon if it is running (runs locally otherwise)",
+    )
+    parser.add_argument(
+        "--daemon_address",
+        help="host:port of the local daemon",
+        type=str,
+        default=DEFAULT_DAEMON_ADDRESS,
+    )
+    parser.add_argument(
+        "--daemon_workers",
+        help="amount of jobs the daemon processes in parallel",
+        type=int,
+        default=1,
+    )
+    return parser
+
+
+def parse_size(size):
+    """Parses a memory size such as '4G', '512M' or '1.5G' to bytes."""
+
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = size.strip().upper().removesuffix("B")
+    try:
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid memory size '{size}'")
+
+
+def parse_args():
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.serve or args.autotune:
+        return args
+
+    # Merge shards outputs
+    if args.merge_manifests is not None or args.merge_reports is not None:
+        if args.merge_manifests is not None and args.manifest is None:
+            parser.error("--merge_manifests requires --manifest")
+        if args.merge_reports is not None and args.report is None:
+            parser.error("--merge_reports requires --report")
+        return args
+
+    # Validate modules & outputs
+    if args.module is None:
+        parser.error("the following arguments are required: in_img_path, out_img_path, module")
+    args.modules = args.module.split(",")
+    args.out_img_paths = args.out_img_path.split(",")
+    for module in args.modules:
+        if module not in MODULES:
+            parser.error(f"invalid module '{module}' (choose from {', '.join(MODULES)})")
+    if len(set(args.modules)) != len(args.modules):
+        parser.error("each module can only be given once")
+    if args.batch:
+        if not os.path.isdir(args.in_img_path):
+            parser.error("in_img_path must be a directory in batch mode")
+    elif len(args.modules) != len(args.out_img_paths):
+        parser.error("one output path must be given per module")
+    if args.bit_depth == 16:
+        import utils_io
+
+        # Batch outputs keep the extension of their input, checked before any job runs
+        out_paths = args.out_img_paths
+        if args.batch:
+            import utils_batch
+
+            out_paths = utils_batch.list_inputs(args.in_img_path)
+        for path in out_paths:
+            extension = os.path.splitext(path)[1].lower()
+            if extension not in utils_io.BIT_DEPTH_16_EXTENSIONS + [".npy"]:
+                parser.error(
+                    f"16 bits output is not supported for '{extension}' images"
+                    + (f" (input '{path}')" if args.batch else "")
+                )
+    for name in ["manifest", "shard", "report", "prometheus_textfile"]:
+        if getattr(args, name) is not None and not args.batch:
+            parser.error(f"--{name} requires --batch")
+    if args.batch_workers < 1:
+        parser.error("--batch_workers must be at least 1")
+    check_options(parser, args)
+    if args.shard is not None:
+        try:
+            import utils_batch
+
+            args.shard_index, args.shard_count = utils_batch.parse_shard(args.shard)
+        except ValueError as err:
+            parser.error(str(err))
+
+    return args
+
+
+def check_options(parser, args):
+    """Checks the processing options values argparse cannot check by itself."""
+
+    if args.normals_to_height_mip_levels < 0:
+        parser.error("--normals_to_height-mip_levels must be positive")
 
 
 def print_progress(current, total):
     print(f"{current}/{total}")
 
 
-# Print progress if verbose enabled
-if args.verbose:
-    progress_callback = print_progress
-else:
-    progress_callback = None
+def load_module(module):
+    """Imports & returns the processing module with the given name."""
+
+    return importlib.import_module("module_" + module)
+
+
+def read_image(path):
+    """Reads an image file (or encoded image bytes) as a C,H,W float32 numpy array in
+    [0,1], see utils_io.read_image."""
+
+    import utils_io
+
+    return utils_io.read_image(path)
+
+
+def write_image(path, img, extension=None, bit_depth=8):
+    """Writes a C,H,W numpy array in [0,1] to an image file. If 'path' is '<bytes>', the
+    encoded image (in the format given by 'extension') is returned instead. See
+    utils_io.write_image."""
+
+    import utils_io
+
+    return utils_io.write_image(path, img, extension, bit_depth)
+
+
+def apply_module(module, in_img, args, progress_callback, preview_callback=None):
+    """Applies a single module to the given C,H,W image. 'preview_callback' is only used
+    by 'color_to_normals' (see its progressive mode)."""
+
+    if module == "color_to_normals":
+        return load_module(module).apply(
+            in_img, args.color_to_normals_overlap, progress_callback, args.max_memory,
+            preview_callback, args.color_to_normals_flat_threshold,
+            args.color_to_normals_seamless == "TRUE"
+        )
+    elif module == "normals_to_curvature":
+        return load_module(module).apply(
+            in_img, args.normals_to_curvature_blur_radius, progress_callback, args.max_memory
+        )
+    elif module == "normals_to_height":
+        return load_module(module).apply(
+            in_img, args.normals_to_height_seamless == "TRUE", progress_callback, args.max_memory,
+            args.normals_to_height_mip_levels
+        )
+    elif module == "lowres_to_highres":
+        return load_module(module).apply(
+            in_img, args.lowres_to_highres_scale_factor, progress_callback, args.max_memory,
+            args.lowres_to_highres_flat_threshold
+        )
+
+
+def mip_levels(module, args):
+    """Returns the amount of mip levels output along 'module' output."""
+
+    if module == "normals_to_height":
+        return args.normals_to_height_mip_levels
+    return 0
+
+
+def output_name(module, level=0):
+    """Returns the name of an output, the module name or 'module_mipN' for mip levels."""
+
+    return module if level == 0 else f"{module}_mip{level}"
+
+
+def with_mip_paths(out_paths, args):
+    """Returns the 'out_paths' dict (module name to output path) completed with the paths
+    of the mip levels (e.g. height_mip1.png), keyed by output_name."""
+
+    paths = dict(out_paths)
+    for module, path in out_paths.items():
+        stem, ext = os.path.splitext(path)
+        for level in range(1, mip_levels(module, args) + 1):
+            paths[output_name(module, level)] = f"{stem}_mip{level}{ext}"
+    return paths
+
+
+def run_modules(in_img, modules, args, progress_callback, output_callback,
+                preview_callback=None, stage_callback=None):
+    """Applies the given modules to the input image. Normal map based modules reuse the
+    in-memory (float) output of 'color_to_normals' if it is part of 'modules', so each
+    intermediate is computed only once. 'output_callback' is called with the module
+    name & its output as soon as each output is available (and once per mip level, with
+    the level as third argument), 'preview_callback' with the progressive previews of
+    'color_to_normals'. 'stage_callback' is called with the name of each module before
+    it runs ('normals_to_height_curvature' when height & curvature are fused)."""
+
+    def stage(module):
+        if stage_callback is not None:
+            stage_callback(module)
 
-# Read input image
-in_img = iio.imread(args.in_img_path)
-# Convert from H,W,C in [0, 256] to C,H,W in [0,1]
-in_img = np.transpose(in_img, (2, 0, 1)) / 255
+    def output(module, out_img):
+        if isinstance(out_img, list):
+            output_callback(module, out_img[0])
+            for level, mip_img in enumerate(out_img[1:], 1):
+                output_callback(module, mip_img, level)
+        else:
+            output_callback(module, out_img)
 
-# Apply processing
-if args.module == "color_to_normals":
-    out_img = module_color_to_normals.apply(
-        in_img, args.color_to_normals_overlap, progress_callback
+    # Compute normals first as other modules might depend on them
+    normals_img = in_img
+    if "color_to_normals" in modules:
+        stage("color_to_normals")
+        normals_img = apply_module(
+            "color_to_normals", in_img, args, progress_callback, preview_callback
+        )
+        output_callback("color_to_normals", normals_img)
+
+    # Height & curvature share their gradients spectra when both are requested (unless
+    # that does not fit in the memory budget). Only when seamless, as the height otherwise
+    # uses mirrored gradients while the curvature wraps around the borders
+    seamless = args.normals_to_height_seamless == "TRUE"
+    fused = (
+        seamless and "normals_to_height" in modules and "normals_to_curvature" in modules
     )
-elif args.module == "normals_to_curvature":
-    out_img = module_normals_to_curvature.apply(
-        in_img, args.normals_to_curvature_blur_radius, progress_callback
+    blur_radius = args.normals_to_curvature_blur_radius
+    if fused and args.max_memory is not None:
+        memory = load_module("normals_to_height_curvature").estimate_memory(
+            normals_img.shape, seamless, blur_radius
+        )
+        fused = memory <= args.max_memory
+    if fused:
+        stage("normals_to_height_curvature")
+        height_img, curvature_img = load_module("normals_to_height_curvature").apply(
+            normals_img, seamless, blur_radius, progress_callback,
+            args.normals_to_height_mip_levels
+        )
+        output("normals_to_height", height_img)
+        output("normals_to_curvature", curvature_img)
+
+    for module in modules:
+        if module == "color_to_normals" or (fused and module in NORMALS_MODULES):
+            continue
+        src_img = normals_img if module in NORMALS_MODULES else in_img
+        stage(module)
+        output(module, apply_module(module, src_img, args, progress_callback))
+
+
+def output_shape(module, in_shape, args, level=0):
+    """Returns the C,H,W shape of the output of 'module' (or of its mip 'level') for an
+    input of 'in_shape'."""
+
+    if level > 0:
+        return (3, max(1, in_shape[1] >> level), max(1, in_shape[2] >> level))
+    if module == "lowres_to_highres":
+        factor = 2 if args.lowres_to_highres_scale_factor == "x2" else 4
+        return (3, in_shape[1] * factor, in_shape[2] * factor)
+    return (3, in_shape[1], in_shape[2])
+
+
+def init_batch_worker(args):
+    """Initializes a batch worker process, loading its own copy of the models once."""
+
+    # Share the cores between workers, unless a thread count was given
+    if args.ort_threads is None:
+        args.ort_threads = max(1, (os.cpu_count() or 1) // args.batch_workers)
+    set_session_options(args)
+    for module in args.modules:
+        if hasattr(load_module(module), "load_model"):
+            load_module(module).load_model()
+
+
+def run_batch_job(descriptors, args):
+    """Applies the modules in a batch worker process. The input image ('<input>') & the
+    module outputs are shared memory arrays (see utils_batch.SharedArray), given by
+    their descriptors. Returns the job statistics (see utils_batch.JobStats)."""
+
+    import utils_batch
+
+    stats = utils_batch.JobStats()
+    shared_arrays = {
+        name: utils_batch.SharedArray.attach(descriptor)
+        for name, descriptor in descriptors.items()
+    }
+    try:
+
+        def write_output(module, out_img, level=0):
+            shared_arrays[output_name(module, level)].array[...] = out_img
+
+        run_modules(
+            shared_arrays["<input>"].array, args.modules, args, stats.progress,
+            write_output, stage_callback=stats.start
+        )
+    finally:
+        for shared in shared_arrays.values():
+            shared.close()
+    return stats.result()
+
+
+def run_batch(args, progress_callback):
+    """Processes every image of the input directory. With a manifest, inputs whose
+    content, modules, options & models did not change since they were last processed
+    are skipped. With several batch workers, images are processed in worker processes,
+    decoded images & outputs being exchanged through shared memory. The run report &
+    metrics are updated as images are done (see utils_batch.RunReport)."""
+
+    import utils_batch
+
+    # Each shard only keeps its share of the inputs
+    in_paths = utils_batch.list_inputs(args.in_img_path)
+    if args.shard is not None:
+        in_paths = [
+            path
+            for path in in_paths
+            if utils_batch.in_shard(path, args.shard_index, args.shard_count)
+        ]
+
+    manifest = None
+    if args.manifest is not None:
+        manifest = utils_batch.Manifest(args.manifest)
+        options = utils_batch.job_options(args.modules, vars(args))
+        model_hashes = {}
+        for module in args.modules:
+            if hasattr(load_module(module), "model_path"):
+                model_hashes[module] = utils_batch.file_hash(load_module(module).model_path)
+
+    report = utils_batch.RunReport(
+        args.shard or "0/1", len(in_paths), args.report, args.prometheus_textfile
     )
-elif args.module == "normals_to_height":
-    out_img = module_normals_to_height.apply(
-        in_img, args.normals_to_height_seamless == "TRUE", progress_callback
+
+    def job_done(record, stats):
+        elapsed = report.add(stats)
+
+        # Only record finished jobs, interrupted ones will be processed again
+        if manifest is not None:
+            record["elapsed"] = elapsed
+            manifest.add(record)
+
+    # Worker jobs in progress, with the shared arrays they use
+    executor = None
+    running = {}
+    if args.batch_workers > 1:
+        import concurrent.futures
+
+        executor = concurrent.futures.ProcessPoolExecutor(
+            args.batch_workers, initializer=init_batch_worker, initargs=(args,)
+        )
+
+    def wait_jobs(max_running):
+        """Writes the outputs of finished worker jobs until at most 'max_running' jobs
+        are left."""
+
+        while len(running) > max_running:
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                record, out_paths, shared_arrays, read_time = running.pop(future)
+                try:
+                    stats = future.result()
+                    write_start_time = time.perf_counter()
+                    for name, out_path in out_paths.items():
+                        write_image(
+                            out_path, shared_arrays[name].array, bit_depth=args.bit_depth
+                        )
+                finally:
+                    for shared in shared_arrays.values():
+                        shared.close()
+                stats["stages"] = {
+                    "read": read_time,
+                    **stats["stages"],
+                    "write": time.perf_counter() - write_start_time,
+                }
+                job_done(record, stats)
+
+    try:
+        for idx, rel_path in enumerate(in_paths):
+            in_path = os.path.join(args.in_img_path, rel_path)
+            out_paths = {
+                module: utils_batch.output_path(args.out_img_path, rel_path, module)
+                for module in args.modules
+            }
+            out_paths = with_mip_paths(out_paths, args)
+
+            record = None
+            if manifest is not None:
+                record = {
+                    "input": rel_path,
+                    "input_hash": utils_batch.file_hash(in_path),
+                    "modules": args.modules,
+                    "options": options,
+                    "model_hashes": model_hashes,
+                    "outputs": out_paths,
+                }
+                if manifest.is_up_to_date(record):
+                    print(f"DeepBump batch : {idx+1}/{len(in_paths)} {rel_path} (unchanged)")
+                    report.skip()
+                    continue
+
+            print(f"DeepBump batch : {idx+1}/{len(in_paths)} {rel_path}")
+            for out_path in out_paths.values():
+                os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+
+            if executor is not None:
+                # Only keep the images of the jobs being processed in memory
+                wait_jobs(args.batch_workers - 1)
+                read_start_time = time.perf_counter()
+                in_shared = utils_batch.SharedArray.from_array(read_image(in_path))
+                read_time = time.perf_counter() - read_start_time
+                shared_arrays = {"<input>": in_shared}
+                in_shape = in_shared.array.shape
+                for module in args.modules:
+                    for level in range(mip_levels(module, args) + 1):
+                        shared_arrays[output_name(module, level)] = (
+                            utils_batch.SharedArray.create(
+                                output_shape(module, in_shape, args, level), "float32"
+                            )
+                        )
+                descriptors = {
+                    name: shared.descriptor() for name, shared in shared_arrays.items()
+                }
+                future = executor.submit(run_batch_job, descriptors, args)
+                running[future] = (record, out_paths, shared_arrays, read_time)
+                continue
+
+            stats = utils_batch.JobStats(progress_callback)
+            stats.start("read")
+            in_img = read_image(in_path)
+
+            # Writing is timed apart from the module running
+            def write_output(module, out_img, level=0):
+                stage = stats.start("write")
+                write_image(
+                    out_paths[output_name(module, level)], out_img, bit_depth=args.bit_depth
+                )
+                stats.start(stage)
+
+            run_modules(
+                in_img, args.modules, args, stats.progress, write_output,
+                stage_callback=stats.start
+            )
+            job_done(record, stats.result())
+
+        if executor is not None:
+            wait_jobs(0)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+            for _, _, shared_arrays, _ in running.values():
+                for shared in shared_arrays.values():
+                    shared.close()
+
+    if manifest is not None:
+        manifest.compact()
+    report.write(done=True)
+
+
+def merge_shards(args):
+    """Merges the manifests and/or timing reports of several shards."""
+
+    import utils_batch
+
+    if args.merge_manifests is not None:
+        utils_batch.merge_manifests(args.merge_manifests, args.manifest)
+    if args.merge_reports is not None:
+        reports = []
+        for path in args.merge_reports:
+            with open(path, "r", encoding="utf-8") as file:
+                reports.append(json.load(file))
+        report = utils_batch.merge_reports(reports)
+        utils_batch.write_report(args.report, report)
+        print(
+            f"DeepBump : {report['processed']} images processed in {report['wall_time']:.1f}s "
+            + f"({report['images_per_second']:.2f} images/s)"
+        )
+
+
+def daemon_token_path():
+    """Returns the path of the file holding the daemon token. Can be overridden with the
+    DEEPBUMP_DAEMON_TOKEN environment variable."""
+
+    path = os.environ.get("DEEPBUMP_DAEMON_TOKEN")
+    if path:
+        return path
+    return os.path.join(os.path.expanduser("~"), ".deepbump", "daemon_token")
+
+
+def trusted_token_file(path):
+    """Returns True if the token file at 'path' is a regular file of the current user
+    that no other user can read or write."""
+
+    import stat
+
+    file_stat = os.lstat(path)
+    if not stat.S_ISREG(file_stat.st_mode):
+        return False
+    # Without POSIX ownership (Windows), the user profile permissions protect it
+    if not hasattr(os, "getuid"):
+        return True
+    return file_stat.st_uid == os.getuid() and file_stat.st_mode & 0o077 == 0
+
+
+def daemon_token(create=False):
+    """Returns the token authenticating requests to the daemon, only readable by the
+    current user (None if there is none, or if another user could have read or written
+    it). With 'create', a new random token is written in that case."""
+
+    path = daemon_token_path()
+    if os.path.lexists(path):
+        if trusted_token_file(path):
+            with open(path, "r", encoding="utf-8") as file:
+                return file.read().strip() or None
+        if not create:
+            return None
+        # Another user could have read or chosen this token, replace it
+        os.remove(path)
+    elif not create:
+        return None
+
+    import secrets
+
+    token = secrets.token_hex(32)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        file.write(token)
+    return token
+
+
+def run_on_daemon(args, progress_callback):
+    """Sends the job described by 'args' to the local daemon & waits for it to finish.
+    Returns False if no daemon is running."""
+
+    import urllib.error
+    import urllib.request
+
+    job = {
+        "in_img_path": os.path.abspath(args.in_img_path),
+        "out_img_paths": [os.path.abspath(path) for path in args.out_img_paths],
+        "modules": args.modules,
+        "options": {
+            "color_to_normals_overlap": args.color_to_normals_overlap,
+            "color_to_normals_flat_threshold": args.color_to_normals_flat_threshold,
+            "color_to_normals_seamless": args.color_to_normals_seamless,
+            "normals_to_curvature_blur_radius": args.normals_to_curvature_blur_radius,
+            "normals_to_height_seamless": args.normals_to_height_seamless,
+            "normals_to_height_mip_levels": args.normals_to_height_mip_levels,
+            "lowres_to_highres_scale_factor": args.lowres_to_highres_scale_factor,
+            "lowres_to_highres_flat_threshold": args.lowres_to_highres_flat_threshold,
+            "max_memory": args.max_memory,
+            "bit_depth": args.bit_depth,
+        },
+    }
+    # Without token, no daemon can have been started by this user
+    token = daemon_token()
+    if token is None:
+        return False
+    request = urllib.request.Request(
+        f"http://{args.daemon_address}/jobs",
+        data=json.dumps(job).encode(),
+        headers={"Content-Type": "application/json", "Authorization": f"Bearer {token}"},
     )
-elif args.module == "lowres_to_highres":
-    out_img = module_lowres_to_highres.apply(
-        in_img, args.lowres_to_highres_scale_factor, progress_callback
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.URLError as err:
+        if isinstance(err.reason, ConnectionRefusedError):
+            return False
+        raise
+
+    # Daemon streams one JSON message per line
+    with response:
+        for line in response:
+            message = json.loads(line)
+            if "progress" in message:
+                if progress_callback is not None:
+                    progress_callback(*message["progress"])
+            elif "error" in message:
+                raise RuntimeError(f"DeepBump daemon : {message['error']}")
+    return True
+
+
+def set_session_options(args):
+    """Sets the ONNX Runtime session options given on the command line, used when models
+    are loaded."""
+
+    options = {
+        "enable_cpu_mem_arena": args.ort_mem_arena,
+        "enable_mem_pattern": args.ort_mem_pattern,
+        "intra_op_num_threads": args.ort_threads,
+    }
+    options = {name: value for name, value in options.items() if value is not None}
+    if options:
+        import utils_inference
+
+        utils_inference.session_options.update(options)
+
+
+def main():
+    args = parse_args()
+    set_session_options(args)
+
+    if args.autotune:
+        import autotune
+
+        autotune.run()
+        return
+
+    # Run as daemon
+    if args.serve:
+        import daemon
+
+        daemon.serve(args.daemon_address, args.daemon_workers)
+        return
+
+    # Print progress if verbose enabled
+    if args.verbose:
+        progress_callback = print_progress
+    else:
+        progress_callback = None
+
+    if args.merge_manifests is not None or args.merge_reports is not None:
+        merge_shards(args)
+        return
+
+    if args.batch:
+        run_batch(args, progress_callback)
+        return
+
+    # Send work to the daemon if it is running
+    if args.daemon and run_on_daemon(args, progress_callback):
+        return
+
+    # Read input image
+    in_img = read_image(args.in_img_path)
+
+    # Apply processing & write each output image
+    out_img_paths = with_mip_paths(dict(zip(args.modules, args.out_img_paths)), args)
+    run_modules(
+        in_img,
+        args.modules,
+        args,
+        progress_callback,
+        lambda module, out_img, level=0: write_image(
+            out_img_paths[output_name(module, level)], out_img, bit_depth=args.bit_depth
+        ),
     )
 
-# Convert from C,H,W in [0,1] to H,W,C in [0, 256]
-out_img = (np.transpose(out_img, (1, 2, 0)) * 255).astype(np.uint8)
-# Write output image
-iio.imwrite(args.out_img_path, out_img)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import base64
+import hmac
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cli
+import module_color_to_normals
+import module_lowres_to_highres
+
+# Job options & their default values, same as the CLI ones
+OPTIONS = [
+    "color_to_normals_overlap",
+    "color_to_normals_flat_threshold",
+    "color_to_normals_seamless",
+    "normals_to_curvature_blur_radius",
+    "normals_to_height_seamless",
+    "normals_to_height_mip_levels",
+    "lowres_to_highres_scale_factor",
+    "lowres_to_highres_flat_threshold",
+    "max_memory",
+    "bit_depth",
+]
+
+# Pending jobs, shared by all workers
+jobs = queue.Queue()
+
+# Minimum time (in seconds) between two previews sent for a job
+PREVIEW_INTERVAL = 1.0
+
+
+class Job:
+    """A processing request. Progress & results are sent to 'events' as dicts, the last
+    one containing either a 'done' or an 'error' key."""
+
+    def __init__(self, request):
+        self.events = queue.Queue()
+
+        # Input is either a file path or base64 encoded image bytes
+        if "in_img_path" in request:
+            self.in_img = request["in_img_path"]
+        else:
+            self.in_img = base64.b64decode(request["in_img"])
+
+        # Outputs are written to files if paths are given, sent back as bytes otherwise
+        self.modules = request["modules"]
+        if not isinstance(self.modules, list):
+            raise ValueError("'modules' must be a list of module names")
+        for module in self.modules:
+            if module not in cli.MODULES:
+                raise ValueError(f"invalid module '{module}'")
+        self.out_img_paths = request.get("out_img_paths")
+        if self.out_img_paths is not None:
+            if not isinstance(self.out_img_paths, list) or not all(
+                isinstance(path, str) for path in self.out_img_paths
+            ):
+                raise ValueError("'out_img_paths' must be a list of paths")
+            if len(self.out_img_paths) != len(self.modules):
+                raise ValueError("one output path must be given per module")
+        self.out_extension = request.get("out_extension", ".png")
+        self.preview = bool(request.get("preview", False))
+
+        self.options = parse_options(request.get("options", {}))
+
+    def run(self):
+        in_img = cli.read_image(self.in_img)
+
+        outputs = {}
+        if self.out_img_paths is not None:
+            out_img_paths = cli.with_mip_paths(
+                dict(zip(self.modules, self.out_img_paths)), self.options
+            )
+
+        # Mip levels are sent back as 'module_mipN' outputs
+        def write_output(module, out_img, level=0):
+            name = cli.output_name(module, level)
+            if self.out_img_paths is not None:
+                path = out_img_paths[name]
+                cli.write_image(path, out_img, bit_depth=self.options.bit_depth)
+                outputs[name] = path
+            else:
+                encoded = cli.write_image(
+                    "<bytes>", out_img, self.out_extension, self.options.bit_depth
+                )
+                outputs[name] = base64.b64encode(encoded).decode()
+
+        def progress(current, total):
+            self.events.put({"progress": [current, total]})
+
+        # Previews are always sent back as bytes, at most every PREVIEW_INTERVAL
+        last_preview = 0.0
+
+        def preview(preview_img):
+            nonlocal last_preview
+            if time.time() - last_preview < PREVIEW_INTERVAL:
+                return
+            encoded = cli.write_image("<bytes>", preview_img, extension=self.out_extension)
+            self.events.put({"preview": base64.b64encode(encoded).decode()})
+            last_preview = time.time()
+
+        cli.run_modules(
+            in_img, self.modules, self.options, progress, write_output,
+            preview if self.preview else None
+        )
+        return outputs
+
+
+def parse_options(options):
+    """Returns the CLI arguments of the given job options, validated like the CLI ones
+    (raises ValueError). Options not given (null, or the default) keep the CLI defaults."""
+
+    if not isinstance(options, dict):
+        raise ValueError("'options' must be an object")
+
+    # Options are passed through the CLI parser, as their command line flags
+    parser = cli.build_parser()
+    flags = {
+        action.dest: action.option_strings[0]
+        for action in parser._actions
+        if action.option_strings
+    }
+    argv = []
+    for name, value in options.items():
+        if name not in OPTIONS:
+            raise ValueError(f"invalid option '{name}'")
+        if value is not None and value != parser.get_default(name):
+            argv += [flags[name], str(value)]
+
+    def error(message):
+        raise ValueError(message)
+
+    parser.error = error
+    args = parser.parse_args(argv)
+    cli.check_options(parser, args)
+    return args
+
+
+def worker():
+    while True:
+        job = jobs.get()
+        try:
+            job.events.put({"done": True, "outputs": job.run()})
+        except Exception as err:
+            job.events.put({"error": str(err)})
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def check_request(self):
+        """Sends an error & returns False unless the request comes from a local client of
+        the same user. Jobs read & write any file the user can, so web pages must not be
+        able to send them : browsers cannot send JSON or authorization headers to another
+        origin without a preflight (which the daemon does not answer), and the host check
+        prevents DNS rebinding. The token is only readable by the user."""
+
+        if self.headers.get("Host") not in self.server.allowed_hosts:
+            self.send_error(403, "invalid host")
+            return False
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip()
+        if content_type != "application/json":
+            self.send_error(415, "jobs must be sent as application/json")
+            return False
+        authorization = self.headers.get("Authorization", "")
+        if not hmac.compare_digest(
+            authorization.encode(), f"Bearer {self.server.token}".encode()
+        ):
+            self.send_error(401, "invalid token")
+            return False
+        return True
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self.send_error(404)
+            return
+        if not self.check_request():
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            job = Job(request)
+        except (ValueError, KeyError, TypeError) as err:
+            self.send_error(400, str(err))
+            return
+
+        # Queue job, it will be picked by the first available worker
+        jobs.put(job)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+
+        # Stream progress until the job is done, one JSON message per line
+        while True:
+            event = job.events.get()
+            self.wfile.write(json.dumps(event).encode() + b"\n")
+            self.wfile.flush()
+            if "done" in event or "error" in event:
+                break
+
+    def log_message(self, format, *args):
+        print("DeepBump daemon : " + format % args)
+
+
+def serve(address, workers=1):
+    """Runs the daemon on 'address' (host:port) until interrupted. Models are loaded once
+    at startup, then jobs are processed by 'workers' threads. Requests must carry the
+    token of cli.daemon_token (created on first start)."""
+
+    # Keep models warm
+    print("DeepBump daemon : loading models")
+    module_color_to_normals.load_model()
+    module_lowres_to_highres.load_model()
+
+    for _ in range(workers):
+        threading.Thread(target=worker, daemon=True).start()
+
+    host, port = address.rsplit(":", 1)
+    server = ThreadingHTTPServer((host, int(port)), RequestHandler)
+    server.token = cli.daemon_token(create=True)
+    server.allowed_hosts = {address, f"127.0.0.1:{port}", f"localhost:{port}"}
+    print(f"DeepBump daemon : listening on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
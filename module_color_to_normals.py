@@ -1,58 +1,335 @@
 import numpy as np
 import pathlib
-import onnxruntime as ort
+import threading
 try :
     from . import utils_inference
 except ImportError:
     # Cannot use . import when using as CLI
     import utils_inference
 
-# Disable MS telemetry
-ort.disable_telemetry_events()
+model_path = str(pathlib.Path(__file__).parent.absolute()) + "/deepbump256.onnx"
 
-def apply(color_img, overlap, progress_callback):
-    """Computes a normal map from the given color map. 'color_img' must be a numpy array
-    in C,H,W format (with C as RGB). 'overlap' must be one of 'SMALL', 'MEDIUM', 'LARGE'."""
+# Largest side of the downscaled image inferred first in progressive mode
+preview_size = 512
 
-    # Remove alpha & convert to grayscale
-    img = np.mean(color_img[0:3], axis=0, keepdims=True).astype(np.float32)
+# Model session, loaded on first use & kept warm for subsequent calls
+ort_session = None
+ort_session_lock = threading.Lock()
+
+def load_model():
+    """Returns the model ONNX Runtime session, loading it on first call."""
+
+    global ort_session
+    with ort_session_lock:
+        if ort_session is None:
+            ort_session = utils_inference.create_session(model_path)
+    return ort_session
+
+def get_stride_size(overlap, tile_size):
+    """Returns the tiles stride for the given 'overlap' ('SMALL', 'MEDIUM', 'LARGE')."""
 
-    # Split image in tiles
-    print("DeepBump Color → Normals : tilling")
-    tile_size = 256
     overlaps = {
         "SMALL": tile_size // 6,
         "MEDIUM": tile_size // 4,
         "LARGE": tile_size // 2,
     }
-    stride_size = tile_size - overlaps[overlap]
+    return tile_size - overlaps[overlap]
+
+def estimate_memory(img_shape, overlap, low_memory=False):
+    """Returns an estimate (in bytes) of the peak memory used by apply for a color image
+    of shape 'img_shape' (C,H,W), not counting the input image itself."""
+
+    tile_size = 256
+    stride_size = get_stride_size(overlap, tile_size)
+    img_h, img_w = img_shape[1], img_shape[2]
+    pad_left, pad_right, pad_top, pad_bottom = utils_inference.tiles_paddings(
+        (img_h, img_w), (tile_size, tile_size), (stride_size, stride_size)
+    )
+    padded_h, padded_w = img_h + pad_top + pad_bottom, img_w + pad_left + pad_right
+    tiles_nb = (((padded_h - tile_size) // stride_size) + 1) * (
+        ((padded_w - tile_size) // stride_size) + 1
+    )
+
+    # Grayscale & padded float32 images
+    size = 4 * img_h * img_w + 4 * padded_h * padded_w
+    if low_memory:
+        # float32 merge buffer, predictions are merged as they come & normalized in place
+        size += 3 * 4 * padded_h * padded_w
+    else:
+        # float32 predictions, merge buffer & normalization temporaries
+        size += tiles_nb * 3 * 4 * tile_size * tile_size
+        size += 3 * 4 * padded_h * padded_w + 4 * 3 * 4 * img_h * img_w
+    return size
+
+def tiles_split(img, tile_size, stride_size, seamless):
+    """Splits 'img' in tiles, wrapping around its borders if 'seamless'. Returns the
+    tiles & their layout (paddings, or tiles positions if 'seamless'), to be given to
+    tiles_merger."""
+
+    if seamless:
+        return utils_inference.tiles_split_seamless(img, tile_size, stride_size)
+    return utils_inference.tiles_split(img, tile_size, stride_size)
+
+def tiles_merger(tile_size, stride_size, img_size, layout, seamless):
+    """Returns a float32 merger for the tiles of tiles_split."""
+
+    if seamless:
+        return utils_inference.SeamlessTilesMerger(
+            tile_size, stride_size, img_size, layout, dtype=np.float32
+        )
+    return utils_inference.TilesMerger(
+        tile_size, stride_size, img_size, layout, dtype=np.float32
+    )
+
+def infer_preview(img, tile_size, stride_size, ort_session, seamless=False):
+    """Returns a normal map inferred on a downscaled copy of the grayscale image 'img'
+    (1,H,W), upsampled back to full size, or None if the image is already small."""
+
+    factor = -(-max(img.shape[1], img.shape[2]) // preview_size)
+    if factor <= 1:
+        return None
+
+    small_img = utils_inference.downscale(img, factor)
+    tiles, layout = tiles_split(small_img, tile_size, stride_size, seamless)
+    pred_tiles = utils_inference.tiles_infer(tiles, ort_session)
+    merge = utils_inference.tiles_merge_seamless if seamless else utils_inference.tiles_merge
+    pred_img = merge(
+        pred_tiles, stride_size, (3, small_img.shape[1], small_img.shape[2]), layout
+    )
+    pred_img = utils_inference.normalize_inplace(pred_img).astype(np.float32)
+    pred_img = utils_inference.upsample(pred_img, factor, img.shape[1:3])
+    return utils_inference.normalize_inplace(pred_img)
+
+def apply_progressive(img, tiles, layout, tile_size, stride_size, ort_session,
+                      progress_callback, preview_callback, low_memory, flat,
+                      seamless=False):
+    """Tiles inference of apply, giving previews to 'preview_callback' along the way."""
+
+    # Fast preview from a downscaled copy (flat normals if the image is already small)
+    preview = infer_preview(img, tile_size, stride_size, ort_session, seamless)
+    if preview is None:
+        preview = np.empty((3, img.shape[1], img.shape[2]), dtype=np.float32)
+        preview[:] = np.array([0.5, 0.5, 1.0], dtype=np.float32)[:, None, None]
+    else:
+        preview_callback(preview)
+
+    # Full resolution tiles, refining the preview each time a row of tiles is done (at
+    # the end only if 'seamless', as the last row of tiles wraps over the first one)
+    merger = tiles_merger(
+        tile_size, stride_size, (3, img.shape[1], img.shape[2]), layout, seamless
+    )
+    done_rows = 0
+
+    def tile_callback(idx, pred):
+        nonlocal done_rows
+        merger.add(idx, pred)
+        rows = merger.final_rows(idx)
+        if rows > done_rows:
+            preview[:, done_rows:rows] = utils_inference.normalize(
+                merger.result()[:, done_rows:rows]
+            )
+            done_rows = rows
+            preview_callback(preview)
+
+    utils_inference.tiles_infer(
+        tiles, ort_session, progress_callback=progress_callback,
+        tile_callback=tile_callback, flat=flat
+    )
+    if low_memory:
+        return utils_inference.normalize_inplace(merger.result())
+    return utils_inference.normalize(merger.result())
+
+def apply_incremental(color_img, overlap, progress_callback, prev_color_img=None,
+                      prev_pred_img=None, prev_pred_tiles=None):
+    """Same as apply, but only the tiles whose input changed since a previous call on
+    'prev_color_img' (which returned 'prev_pred_img' & 'prev_pred_tiles', with the same
+    'overlap') are inferred again, & only the area they cover is blended again. Returns
+    the (pred_img, pred_tiles) pair to be given to the next call, 'pred_tiles' being the
+    predictions of each tile (float32, about 4 times the output size with a 'LARGE'
+    overlap). Without previous call, or if the image size changed, all tiles are
+    inferred."""
+
+    if prev_pred_tiles is not None and prev_color_img is None:
+        raise ValueError("prev_color_img must be given along prev_pred_tiles")
+
+    # Remove alpha & convert to grayscale
+    img = np.mean(color_img[0:3], axis=0, keepdims=True).astype(np.float32)
+
+    # Split image in tiles
+    tile_size = 256
+    stride_size = get_stride_size(overlap, tile_size)
     tiles, paddings = utils_inference.tiles_split(
         img, (tile_size, tile_size), (stride_size, stride_size)
     )
 
+    # Compare to the previous input tiles (their size gives the receptive area of each
+    # prediction)
+    if prev_pred_tiles is not None and prev_color_img.shape == color_img.shape:
+        prev_img = np.mean(prev_color_img[0:3], axis=0, keepdims=True).astype(np.float32)
+        prev_tiles, _ = utils_inference.tiles_split(
+            prev_img, (tile_size, tile_size), (stride_size, stride_size)
+        )
+        changed = utils_inference.changed_tiles(tiles, prev_tiles)
+        pred_tiles = list(prev_pred_tiles)
+    else:
+        changed = [True] * len(tiles)
+        pred_tiles = [None] * len(tiles)
+        prev_pred_img = None
+    indices = [idx for idx in range(len(tiles)) if changed[idx]]
+    print(f"DeepBump Color → Normals : {len(indices)}/{len(tiles)} tiles changed")
+
+    # Predict changed tiles only
+    ort_session = load_model()
+
+    def tile_callback(idx, pred):
+        pred_tiles[indices[idx]] = pred.copy()
+
+    utils_inference.tiles_infer(
+        [tiles[idx] for idx in indices], ort_session, progress_callback=progress_callback,
+        tile_callback=tile_callback
+    )
+
+    # Merge all tiles if most of them changed
+    if prev_pred_img is None or len(indices) > len(tiles) // 4:
+        pred_img = utils_inference.tiles_merge(
+            pred_tiles,
+            (stride_size, stride_size),
+            (3, img.shape[1], img.shape[2]),
+            paddings,
+            dtype=np.float32,
+        )
+        return utils_inference.normalize_inplace(pred_img), pred_tiles
+
+    # Otherwise blend again the area covered by each changed tile (clipped to the valid
+    # part, changes near borders also change tiles on the other side as the padding wraps)
+    pad_left, _, pad_top, _ = paddings
+    img_h, img_w = img.shape[1], img.shape[2]
+    padded_size = (img_h + paddings[2] + paddings[3], img_w + paddings[0] + paddings[1])
+    w_range = ((padded_size[1] - tile_size) // stride_size) + 1
+    pred_img = prev_pred_img.copy()
+    for idx in indices:
+        h, w = idx // w_range, idx % w_range
+        h_from = max(h * stride_size, pad_top)
+        h_to = min(h * stride_size + tile_size, pad_top + img_h)
+        w_from = max(w * stride_size, pad_left)
+        w_to = min(w * stride_size + tile_size, pad_left + img_w)
+        if h_from >= h_to or w_from >= w_to:
+            continue
+        merged = utils_inference.tiles_merge_region(
+            pred_tiles, (stride_size, stride_size), padded_size,
+            ((h_from, h_to), (w_from, w_to)), dtype=np.float32
+        )
+        pred_img[:, h_from - pad_top : h_to - pad_top, w_from - pad_left : w_to - pad_left] = (
+            utils_inference.normalize_inplace(merged)
+        )
+
+    return pred_img, pred_tiles
+
+def apply(color_img, overlap, progress_callback, max_memory=None, preview_callback=None,
+          flat_threshold=None, seamless=False):
+    """Computes a normal map from the given color map. 'color_img' must be a numpy array
+    in C,H,W format (with C as RGB). 'overlap' must be one of 'SMALL', 'MEDIUM', 'LARGE'.
+    If the estimated memory use exceeds 'max_memory' (in bytes), predictions are merged
+    as they come, in float32, instead of being kept until all tiles are done.
+
+    If 'preview_callback' is given, it is first called with a normal map inferred on a
+    downscaled copy of the image (upsampled to full size), then called again with the
+    same array, refined in place, each time a row of full resolution tiles is done. The
+    last call gives the final normal map (in float32).
+
+    If 'flat_threshold' is given, tiles whose variance is below it are not inferred but
+    get the prediction of a constant tile (computed once per value).
+
+    If 'seamless', the image is treated as tileable : tiles wrap around its borders
+    instead of covering a padding ring, which takes fewer tiles & gives a seamless
+    normal map."""
+
+    low_memory = (
+        max_memory is not None
+        and estimate_memory(color_img.shape, overlap) > max_memory
+    )
+    if low_memory and estimate_memory(color_img.shape, overlap, True) > max_memory:
+        print("DeepBump Color → Normals : warning, the low memory mode still exceeds the memory budget")
+
+    # Remove alpha & convert to grayscale
+    img = np.mean(color_img[0:3], axis=0, keepdims=True).astype(np.float32)
+
+    # Split image in tiles
+    print("DeepBump Color → Normals : tilling")
+    tile_size = 256
+    stride_size = get_stride_size(overlap, tile_size)
+    tiles, layout = tiles_split(
+        img, (tile_size, tile_size), (stride_size, stride_size), seamless
+    )
+
+    # Flat tiles (e.g. solid color areas) get the prediction of a constant tile
+    flat = None
+    if flat_threshold is not None:
+        flat = utils_inference.flat_tiles(tiles, flat_threshold)
+        print(f"DeepBump Color → Normals : skipping {sum(flat)}/{len(tiles)} flat tiles")
+
     # Load model
     print("DeepBump Color → Normals : loading model")
-    addon_path = str(pathlib.Path(__file__).parent.absolute())
-    ort_session = ort.InferenceSession(
-        addon_path + "/deepbump256.onnx", providers=["CPUExecutionProvider"]
-    )
+    ort_session = load_model()
+
+    if preview_callback is not None:
+        print("DeepBump Color → Normals : generating (progressive)")
+        return apply_progressive(
+            img, tiles, layout, (tile_size, tile_size), (stride_size, stride_size),
+            ort_session, progress_callback, preview_callback, low_memory, flat, seamless
+        )
+
+    # Predict & merge tiles one at a time to stay within memory budget
+    if low_memory:
+        print("DeepBump Color → Normals : generating (low memory)")
+        merger = tiles_merger(
+            (tile_size, tile_size),
+            (stride_size, stride_size),
+            (3, img.shape[1], img.shape[2]),
+            layout,
+            seamless,
+        )
+        utils_inference.tiles_infer(
+            tiles, ort_session, progress_callback=progress_callback,
+            tile_callback=merger.add, flat=flat
+        )
+        return utils_inference.normalize_inplace(merger.result())
 
     # Predict normal map for each tile
     print("DeepBump Color → Normals : generating")
     pred_tiles = utils_inference.tiles_infer(
-        tiles, ort_session, progress_callback=progress_callback
+        tiles, ort_session, progress_callback=progress_callback, flat=flat
     )
 
-    # Merge tiles
+    # Merge tiles (in float32, as predictions, which halves the merge memory traffic)
     print("DeepBump Color → Normals : merging")
-    pred_img = utils_inference.tiles_merge(
+    merge = utils_inference.tiles_merge_seamless if seamless else utils_inference.tiles_merge
+    pred_img = merge(
         pred_tiles,
         (stride_size, stride_size),
         (3, img.shape[1], img.shape[2]),
-        paddings,
+        layout,
+        dtype=np.float32,
     )
 
     # Normalize each pixel to unit vector
-    pred_img = utils_inference.normalize(pred_img)
+    pred_img = utils_inference.normalize_inplace(pred_img)
 
     return pred_img
+
+async def apply_async(color_img, overlap, executor=None, **kwargs):
+    """Same as apply, run on 'executor' (see utils_async) without blocking the asyncio
+    event loop. Returns a utils_async.Job, streaming the progress & giving the
+    normal map once awaited."""
+
+    # asyncio is only imported by the services using it
+    try:
+        from . import utils_async
+    except ImportError:
+        # Cannot use . import when using as CLI
+        import utils_async
+
+    return await utils_async.submit(
+        lambda progress_callback: apply(color_img, overlap, progress_callback, **kwargs),
+        executor,
+    )
@@ -1,6 +1,6 @@
 import numpy as np
 import pathlib
-import onnxruntime as ort
+import threading
 import math
 
 try:
@@ -9,8 +9,21 @@ except ImportError:
     # Cannot use . import when using as CLI
     import utils_inference
 
-# Disable MS telemetry
-ort.disable_telemetry_events()
+model_path = str(pathlib.Path(__file__).parent.absolute()) + "/upscale256.onnx"
+
+# Model session, loaded on first use & kept warm for subsequent calls
+ort_session = None
+ort_session_lock = threading.Lock()
+
+
+def load_model():
+    """Returns the model ONNX Runtime session, loading it on first call."""
+
+    global ort_session
+    with ort_session_lock:
+        if ort_session is None:
+            ort_session = utils_inference.create_session(model_path)
+    return ort_session
 
 
 def downscale_x2(img):
@@ -87,73 +100,153 @@ def random_pair_shuffle(img, col1, col2, ratio=0.5):
     return img
 
 
+class TilesMerger:
+    """Merges tiles one at a time given an upscale factor and without overlap, so that
+    upscaled tiles do not need to be kept in memory. img_size is the original size,
+    before upscale & padding."""
+
+    def __init__(self, tile_size, img_shape, paddings, upscale_factor=4, dtype=np.float64):
+        self.w_range = math.ceil(img_shape[2] / tile_size)
+        pad_left, pad_right, pad_top, pad_bottom = paddings
+        width = img_shape[2] + pad_left + pad_right
+        height = img_shape[1] + pad_top + pad_bottom
+
+        # Upscale dims
+        self.tile_size = tile_size * upscale_factor
+        self.paddings = [pad * upscale_factor for pad in paddings]
+        self.merged = np.zeros(
+            [img_shape[0], height * upscale_factor, width * upscale_factor], dtype=dtype
+        )
+
+    def add(self, idx, tile):
+        """Adds the tile at index idx (in tiles_split order)."""
+
+        h, w = idx // self.w_range, idx % self.w_range
+        h_from, h_to = h * self.tile_size, (h + 1) * self.tile_size
+        w_from, w_to = w * self.tile_size, (w + 1) * self.tile_size
+        self.merged[:, h_from:h_to, w_from:w_to] = tile
+
+    def result(self):
+        """Returns the merged image, with smoothed tiles edges & cropped to the original
+        size (upscaled)."""
+
+        _, height, width = self.merged.shape
+        pad_left, pad_right, pad_top, pad_bottom = self.paddings
+        merged = pixel_shuffle(self.merged, self.tile_size)
+
+        return merged[:, pad_top : height - pad_bottom, pad_left : width - pad_right]
+
+
 def tiles_merge(tiles, tile_size, img_shape, paddings, upscale_factor=4):
     """Merges the list of tiles given an upscale factor and without overlap.
     img_size is the original size, before upscale & padding."""
 
-    h_range = math.ceil(img_shape[1] / tile_size)
-    w_range = math.ceil(img_shape[2] / tile_size)
-    pad_left, pad_right, pad_top, pad_bottom = paddings
-    width = img_shape[2] + pad_left + pad_right
-    height = img_shape[1] + pad_top + pad_bottom
+    merger = TilesMerger(tile_size, img_shape, paddings, upscale_factor)
+    for idx, tile in enumerate(tiles):
+        merger.add(idx, tile)
+    return merger.result()
 
-    # Upscale dims
-    tile_size *= upscale_factor
-    width *= upscale_factor
-    height *= upscale_factor
-    pad_left *= upscale_factor
-    pad_right *= upscale_factor
-    pad_top *= upscale_factor
-    pad_bottom *= upscale_factor
 
-    merged = np.zeros([img_shape[0], height, width])
-    idx = 0
-    for h in range(0, h_range):
-        for w in range(0, w_range):
-            h_from, h_to = h * tile_size, (h + 1) * tile_size
-            w_from, w_to = w * tile_size, (w + 1) * tile_size
-            merged[:, h_from:h_to, w_from:w_to] = tiles[idx]
-            idx += 1
+def estimate_memory(img_shape, scale_factor, low_memory=False):
+    """Returns an estimate (in bytes) of the peak memory used by apply for an image of
+    shape 'img_shape' (C,H,W), not counting the input image itself."""
 
-    merged = pixel_shuffle(merged, tile_size)
-
-    return merged[:, pad_top : height - pad_bottom, pad_left : width - pad_right]
+    tile_size = 256
+    img_h, img_w = img_shape[1], img_shape[2]
+    padded_h = math.ceil(img_h / tile_size) * tile_size
+    padded_w = math.ceil(img_w / tile_size) * tile_size
+
+    # Input & padded float32 images, upscaled merge buffer
+    size = 3 * 4 * (img_h * img_w + padded_h * padded_w)
+    if low_memory:
+        # float32 merge buffer, tiles are merged as they come & clipped in place
+        size += 3 * 4 * 16 * padded_h * padded_w
+    else:
+        # float32 upscaled tiles, float64 merge buffer & clipping masks
+        size += 3 * (4 + 8 + 2) * 16 * padded_h * padded_w
+    if scale_factor == "x2":
+        # Downscaled copy
+        size += 3 * 8 * 16 * img_h * img_w
+    return size
 
 
-def apply(color_img, scale_factor, progress_callback):
+def apply(color_img, scale_factor, progress_callback, max_memory=None, flat_threshold=None):
     """Upscale image. 'color_img' must be a numpy array in C,H,W format (with C as RGB).
-    'factor'' must be 'x2' or 'x4'."""
+    'factor'' must be 'x2' or 'x4'. If the estimated memory use exceeds 'max_memory' (in
+    bytes), tiles are merged as they come, in float32, instead of being kept until all
+    tiles are done. If 'flat_threshold' is given, tiles whose variance is below it are
+    not inferred but get the prediction of a constant tile (computed once per value)."""
+
+    low_memory = (
+        max_memory is not None
+        and estimate_memory(color_img.shape, scale_factor) > max_memory
+    )
+    if low_memory and estimate_memory(color_img.shape, scale_factor, True) > max_memory:
+        print("DeepBump Low Res -> High Res : warning, the low memory mode still exceeds the memory budget")
 
     # Remove alpha & convert to fp16 (model is in fp16)
     img = color_img[0:3].astype(np.float32)
 
     # Load model
     print("DeepBump Low Res -> High Res : loading model")
-    addon_path = str(pathlib.Path(__file__).parent.absolute())
-    ort_session = ort.InferenceSession(
-        addon_path + "/upscale256.onnx", providers=["CPUExecutionProvider"]
-    )
+    ort_session = load_model()
 
     # Split in tiles
     print("DeepBump Low Res -> High Res : generating")
     tile_size = 256
     tiles, paddings = tiles_split(img, tile_size)
 
-    # Upscale each tile
-    pred_tiles = utils_inference.tiles_infer(
-        tiles, ort_session, progress_callback=progress_callback
-    )
+    # Flat tiles (e.g. solid color areas) get the prediction of a constant tile
+    flat = None
+    if flat_threshold is not None:
+        flat = utils_inference.flat_tiles(tiles, flat_threshold)
+        print(f"DeepBump Low Res -> High Res : skipping {sum(flat)}/{len(tiles)} flat tiles")
+
+    if low_memory:
+        # Upscale & merge tiles one at a time to stay within memory budget
+        print("DeepBump Low Res -> High Res : low memory mode")
+        merger = TilesMerger(tile_size, img.shape, paddings, dtype=np.float32)
+        utils_inference.tiles_infer(
+            tiles, ort_session, progress_callback=progress_callback,
+            tile_callback=merger.add, flat=flat
+        )
+        pred_img = merger.result()
+
+        # Clip to [0 .1]
+        np.clip(pred_img, 0.0, 1.0, out=pred_img)
+    else:
+        # Upscale each tile
+        pred_tiles = utils_inference.tiles_infer(
+            tiles, ort_session, progress_callback=progress_callback, flat=flat
+        )
 
-    # Merge tiles
-    print("DeepBump Low Res -> High Res : merging")
-    pred_img = tiles_merge(pred_tiles, tile_size, img.shape, paddings)
+        # Merge tiles
+        print("DeepBump Low Res -> High Res : merging")
+        pred_img = tiles_merge(pred_tiles, tile_size, img.shape, paddings)
 
-    # Clip to [0 .1]
-    pred_img[pred_img > 1.0] = 1.0
-    pred_img[pred_img < 0.0] = 0.0
+        # Clip to [0 .1]
+        np.clip(pred_img, 0.0, 1.0, out=pred_img)
 
     # Resize according to scale factor
     if scale_factor == "x2":
         pred_img = downscale_x2(pred_img)
 
     return pred_img
+
+
+async def apply_async(color_img, scale_factor, executor=None, **kwargs):
+    """Same as apply, run on 'executor' (see utils_async) without blocking the asyncio
+    event loop. Returns a utils_async.Job, streaming the progress & giving the
+    upscaled image once awaited."""
+
+    # asyncio is only imported by the services using it
+    try:
+        from . import utils_async
+    except ImportError:
+        # Cannot use . import when using as CLI
+        import utils_async
+
+    return await utils_async.submit(
+        lambda progress_callback: apply(color_img, scale_factor, progress_callback, **kwargs),
+        executor,
+    )
@@ -1,91 +1,228 @@
-import numpy as np
-
-
-def conv_1d(array, kernel_1d):
-    """Performs row by row 1D convolutions of the given 2D image with the given 1D kernel."""
-
-    # Input kernel length must be odd
-    k_l = len(kernel_1d)
-    assert k_l % 2 != 0
-    # Convolution is repeat-padded
-    extended = np.pad(array, k_l // 2, mode="wrap")
-    # Output has same size as input (padded, valid-mode convolution)
-    output = np.empty(array.shape)
-    for i in range(0, array.shape[0]):
-        output[i] = np.convolve(extended[i + (k_l // 2)], kernel_1d, mode="valid")
-
-    return output * -1
-
-
-def gaussian_kernel(length, sigma):
-    """Returns a 1D gaussian kernel of size 'length'."""
-
-    space = np.linspace(-(length - 1) / 2, (length - 1) / 2, length)
-    kernel = np.exp(-0.5 * np.square(space) / np.square(sigma))
-    return kernel / np.sum(kernel)
-
-
-def normalize(np_array):
-    """Normalize all elements of the given numpy array to [0,1]"""
-
-    return (np_array - np.min(np_array)) / (np.max(np_array) - np.min(np_array))
-
-
-def apply(normals_img, blur_radius, progress_callback):
-    """Computes a curvature map from the given normal map. 'normals_img' must be a numpy array
-    in C,H,W format (with C as RGB). 'blur_radius' must be one of 'SMALLEST', 'SMALLER', 'SMALL',
-    'MEDIUM', 'LARGE', 'LARGER', 'LARGEST'."""
-
-    # Convolutions on normal map red & green channels
-    if progress_callback is not None:
-        progress_callback(0, 4)
-    diff_kernel = np.array([-1, 0, 1])
-    h_conv = conv_1d(normals_img[0, :, :], diff_kernel)
-    if progress_callback is not None:
-        progress_callback(1, 4)
-    v_conv = conv_1d(-1 * normals_img[1, :, :].T, diff_kernel).T
-    if progress_callback is not None:
-        progress_callback(2, 4)
-
-    # Sum detected edges
-    edges_conv = h_conv + v_conv
-
-    # Blur radius size is proportional to img sizes
-    blur_factors = {
-        "SMALLEST": 1 / 256,
-        "SMALLER": 1 / 128,
-        "SMALL": 1 / 64,
-        "MEDIUM": 1 / 32,
-        "LARGE": 1 / 16,
-        "LARGER": 1 / 8,
-        "LARGEST": 1 / 4,
-    }
-    assert blur_radius in blur_factors
-    blur_radius_px = int(np.mean(normals_img.shape[1:3]) * blur_factors[blur_radius])
-
-    # If blur radius too small, do not blur
-    if blur_radius_px < 2:
-        edges_conv = normalize(edges_conv)
-        return np.stack([edges_conv, edges_conv, edges_conv])
-
-    # Make sure blur kernel length is odd
-    if blur_radius_px % 2 == 0:
-        blur_radius_px += 1
-
-    # Blur curvature with separated convolutions
-    sigma = blur_radius_px // 8
-    if sigma == 0:
-        sigma = 1
-    g_kernel = gaussian_kernel(blur_radius_px, sigma)
-    h_blur = conv_1d(edges_conv, g_kernel)
-    if progress_callback is not None:
-        progress_callback(3, 4)
-    v_blur = conv_1d(h_blur.T, g_kernel).T
-    if progress_callback is not None:
-        progress_callback(4, 4)
-
-    # Normalize to [0,1]
-    curvature = normalize(v_blur)
-
-    # Expand single channel the three channels (RGB)
-    return np.stack([curvature, curvature, curvature])
+import numpy as np
+
+try:
+    from . import utils_postprocess
+except ImportError:
+    # Cannot use . import when using as CLI
+    import utils_postprocess
+
+
+def conv_1d(array, kernel_1d):
+    """Performs row by row 1D convolutions of the given 2D image with the given 1D kernel."""
+
+    # Input kernel length must be odd
+    k_l = len(kernel_1d)
+    assert k_l % 2 != 0
+    # Convolution is repeat-padded
+    extended = np.pad(array, k_l // 2, mode="wrap")
+    # Output has same size as input (padded, valid-mode convolution)
+    output = np.empty(array.shape)
+    for i in range(0, array.shape[0]):
+        output[i] = np.convolve(extended[i + (k_l // 2)], kernel_1d, mode="valid")
+
+    return output * -1
+
+
+def conv_1d_chunked(array, kernel_1d, output, chunk_rows=64):
+    """Same as conv_1d, but writes into 'output' & pads the rows by chunks, to avoid full
+    size padded copies."""
+
+    # Input kernel length must be odd
+    k_l = len(kernel_1d)
+    assert k_l % 2 != 0
+    for row in range(0, array.shape[0], chunk_rows):
+        # Convolution is repeat-padded (only rows are convolved, so only pad them)
+        extended = np.pad(array[row : row + chunk_rows], ((0, 0), (k_l // 2, k_l // 2)), mode="wrap")
+        for i in range(0, extended.shape[0]):
+            output[row + i] = np.convolve(extended[i], kernel_1d, mode="valid")
+            output[row + i] *= -1
+
+    return output
+
+
+def gaussian_kernel(length, sigma):
+    """Returns a 1D gaussian kernel of size 'length'."""
+
+    space = np.linspace(-(length - 1) / 2, (length - 1) / 2, length)
+    kernel = np.exp(-0.5 * np.square(space) / np.square(sigma))
+    return kernel / np.sum(kernel)
+
+
+def blur_kernel(img_shape, blur_radius):
+    """Returns the 1D gaussian kernel used to blur the curvature of an image of shape
+    'img_shape' (C,H,W), or None if the blur radius is too small to blur."""
+
+    # Blur radius size is proportional to img sizes
+    blur_factors = {
+        "SMALLEST": 1 / 256,
+        "SMALLER": 1 / 128,
+        "SMALL": 1 / 64,
+        "MEDIUM": 1 / 32,
+        "LARGE": 1 / 16,
+        "LARGER": 1 / 8,
+        "LARGEST": 1 / 4,
+    }
+    assert blur_radius in blur_factors
+    blur_radius_px = int(np.mean(img_shape[1:3]) * blur_factors[blur_radius])
+
+    # If blur radius too small, do not blur
+    if blur_radius_px < 2:
+        return None
+
+    # Make sure blur kernel length is odd
+    if blur_radius_px % 2 == 0:
+        blur_radius_px += 1
+
+    sigma = blur_radius_px // 8
+    if sigma == 0:
+        sigma = 1
+    return gaussian_kernel(blur_radius_px, sigma)
+
+
+def kernel_spectrum(kernel_1d, length):
+    """Returns the 1D Fourier transform of the given kernel, laid out so that multiplying
+    a spectrum of size 'length' by it matches conv_1d (without its sign flip)."""
+
+    # Center the kernel on index 0, wrapping around like conv_1d padding does
+    k_l = len(kernel_1d)
+    circular = np.zeros(length)
+    np.add.at(circular, (np.arange(k_l) - k_l // 2) % length, kernel_1d)
+    return np.fft.fft(circular)
+
+
+def normalize(np_array):
+    """Normalize all elements of the given numpy array to [0,1]"""
+
+    return utils_postprocess.normalize_range(np_array)
+
+
+def estimate_memory(img_shape, blur_radius, low_memory=False):
+    """Returns an estimate (in bytes) of the peak memory used by apply for a normal map of
+    shape 'img_shape' (C,H,W), not counting the input image itself."""
+
+    img_h, img_w = img_shape[1], img_shape[2]
+    g_kernel = blur_kernel(img_shape, blur_radius)
+    k_l = 3 if g_kernel is None else len(g_kernel)
+    if low_memory:
+        # Two float32 buffers & one padded chunk of rows
+        return 2 * 4 * img_h * img_w + 8 * 64 * (max(img_h, img_w) + k_l)
+
+    # float64 padded copies, convolutions outputs, normalization temporaries & output
+    return 8 * (img_h + k_l) * (img_w + k_l) + 8 * 8 * img_h * img_w
+
+
+def apply_low_memory(normals_img, blur_radius, progress_callback):
+    """Same as apply, but computed in float32 & in place as much as possible."""
+
+    # Convolutions on normal map red & green channels
+    if progress_callback is not None:
+        progress_callback(0, 4)
+    diff_kernel = np.array([-1, 0, 1])
+    edges_conv = np.empty(normals_img.shape[1:3], dtype=np.float32)
+    buffer = np.empty(normals_img.shape[1:3], dtype=np.float32)
+    conv_1d_chunked(normals_img[0, :, :], diff_kernel, edges_conv)
+    if progress_callback is not None:
+        progress_callback(1, 4)
+    # Vertical convolution of the negated green channel
+    conv_1d_chunked(normals_img[1, :, :].T, diff_kernel, buffer.T)
+    if progress_callback is not None:
+        progress_callback(2, 4)
+
+    # Sum detected edges
+    edges_conv -= buffer
+
+    # Blur curvature with separated convolutions, if blur radius is not too small
+    g_kernel = blur_kernel(normals_img.shape, blur_radius)
+    if g_kernel is not None:
+        conv_1d_chunked(edges_conv, g_kernel, buffer)
+        if progress_callback is not None:
+            progress_callback(3, 4)
+        conv_1d_chunked(buffer.T, g_kernel, edges_conv.T)
+        if progress_callback is not None:
+            progress_callback(4, 4)
+    del buffer
+
+    # Normalize to [0,1]
+    utils_postprocess.normalize_range(edges_conv, out=edges_conv)
+
+    # Expand single channel the three channels (RGB), without copies
+    return np.broadcast_to(edges_conv, (3,) + edges_conv.shape)
+
+
+def edges(normals_img, progress_callback=None):
+    """Returns the (unnormalized) edges detected on the normal map red & green channels.
+    First step of apply, which does not depend on the blur radius."""
+
+    # Convolutions on normal map red & green channels
+    if progress_callback is not None:
+        progress_callback(0, 4)
+    diff_kernel = np.array([-1, 0, 1])
+    h_conv = conv_1d(normals_img[0, :, :], diff_kernel)
+    if progress_callback is not None:
+        progress_callback(1, 4)
+    v_conv = conv_1d(-1 * normals_img[1, :, :].T, diff_kernel).T
+    if progress_callback is not None:
+        progress_callback(2, 4)
+
+    # Sum detected edges
+    return h_conv + v_conv
+
+
+def edges_to_curvature(edges_conv, img_shape, blur_radius, progress_callback=None):
+    """Blurs & normalizes the edges given by 'edges' into the curvature map of a normal map
+    of shape 'img_shape' (C,H,W). Second step of apply."""
+
+    # If blur radius too small, do not blur
+    g_kernel = blur_kernel(img_shape, blur_radius)
+    if g_kernel is None:
+        edges_conv = normalize(edges_conv)
+        return np.stack([edges_conv, edges_conv, edges_conv])
+
+    # Blur curvature with separated convolutions
+    h_blur = conv_1d(edges_conv, g_kernel)
+    if progress_callback is not None:
+        progress_callback(3, 4)
+    v_blur = conv_1d(h_blur.T, g_kernel).T
+    if progress_callback is not None:
+        progress_callback(4, 4)
+
+    # Normalize to [0,1]
+    curvature = utils_postprocess.normalize_range(v_blur, out=v_blur)
+
+    # Expand single channel the three channels (RGB)
+    return np.stack([curvature, curvature, curvature])
+
+
+def apply(normals_img, blur_radius, progress_callback, max_memory=None):
+    """Computes a curvature map from the given normal map. 'normals_img' must be a numpy array
+    in C,H,W format (with C as RGB). 'blur_radius' must be one of 'SMALLEST', 'SMALLER', 'SMALL',
+    'MEDIUM', 'LARGE', 'LARGER', 'LARGEST'. If the estimated memory use exceeds 'max_memory'
+    (in bytes), the curvature is computed in float32 & by chunks of rows (the returned array
+    is then a read-only view)."""
+
+    if max_memory is not None and estimate_memory(normals_img.shape, blur_radius) > max_memory:
+        print("DeepBump Normals → Curvature : low memory mode")
+        if estimate_memory(normals_img.shape, blur_radius, True) > max_memory:
+            print("DeepBump Normals → Curvature : warning, the low memory mode still exceeds the memory budget")
+        return apply_low_memory(normals_img, blur_radius, progress_callback)
+
+    edges_conv = edges(normals_img, progress_callback)
+    return edges_to_curvature(edges_conv, normals_img.shape, blur_radius, progress_callback)
+
+
+async def apply_async(normals_img, blur_radius, executor=None, **kwargs):
+    """Same as apply, run on 'executor' (see utils_async) without blocking the asyncio
+    event loop. Returns a utils_async.Job, streaming the progress & giving the
+    curvature map once awaited."""
+
+    # asyncio is only imported by the services using it
+    try:
+        from . import utils_async
+    except ImportError:
+        # Cannot use . import when using as CLI
+        import utils_async
+
+    return await utils_async.submit(
+        lambda progress_callback: apply(normals_img, blur_radius, progress_callback, **kwargs),
+        executor,
+    )
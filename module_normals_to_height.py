@@ -1,88 +1,307 @@
-import numpy as np
-
-
-def normals_to_grad(normals_img):
-    return (normals_img[0] - 0.5) * 2, (normals_img[1] - 0.5) * 2
-
-
-def copy_flip(grad_x, grad_y):
-    """Concat 4 flipped copies of input gradients (makes them wrap).
-    Output is twice bigger in both dimensions."""
-
-    grad_x_top = np.hstack([grad_x, -np.flip(grad_x, axis=1)])
-    grad_x_bottom = np.hstack([np.flip(grad_x, axis=0), -np.flip(grad_x)])
-    new_grad_x = np.vstack([grad_x_top, grad_x_bottom])
-
-    grad_y_top = np.hstack([grad_y, np.flip(grad_y, axis=1)])
-    grad_y_bottom = np.hstack([-np.flip(grad_y, axis=0), -np.flip(grad_y)])
-    new_grad_y = np.vstack([grad_y_top, grad_y_bottom])
-
-    return new_grad_x, new_grad_y
-
-
-def frankot_chellappa(grad_x, grad_y, progress_callback=None):
-    """Frankot-Chellappa depth-from-gradient algorithm."""
-
-    if progress_callback is not None:
-        progress_callback(0,3)
-
-    rows, cols = grad_x.shape
-
-    rows_scale = (np.arange(rows) - (rows // 2 + 1)) / (rows - rows % 2)
-    cols_scale = (np.arange(cols) - (cols // 2 + 1)) / (cols - cols % 2)
-
-    u_grid, v_grid = np.meshgrid(cols_scale, rows_scale)
-
-    u_grid = np.fft.ifftshift(u_grid)
-    v_grid = np.fft.ifftshift(v_grid)
-
-    if progress_callback is not None:
-        progress_callback(1,3)
-
-    grad_x_F = np.fft.fft2(grad_x)
-    grad_y_F = np.fft.fft2(grad_y)
-
-    if progress_callback is not None:
-        progress_callback(2,3)
-
-    nominator = (-1j * u_grid * grad_x_F) + (-1j * v_grid * grad_y_F)
-    denominator = (u_grid**2) + (v_grid**2) + 1e-16
-
-    Z_F = nominator / denominator
-    Z_F[0, 0] = 0.0
-
-    Z = np.real(np.fft.ifft2(Z_F))
-
-    if progress_callback is not None:
-        progress_callback(3,3)
-
-    return (Z - np.min(Z)) / (np.max(Z) - np.min(Z))
-
-
-def apply(normals_img, seamless, progress_callback):
-    """Computes a height map from the given normal map. 'normals_img' must be a numpy array
-    in C,H,W format (with C as RGB). 'seamless' is a bool that should indicates if 'normals_img'
-    is seamless."""
-
-    # Flip height axis
-    flip_img = np.flip(normals_img, axis=1)
-
-    # Get gradients from normal map
-    grad_x, grad_y = normals_to_grad(flip_img)
-    grad_x = np.flip(grad_x, axis=0)
-    grad_y = np.flip(grad_y, axis=0)
-
-    # If non-seamless chosen, expand gradients
-    if not seamless:
-        grad_x, grad_y = copy_flip(grad_x, grad_y)
-
-    # Compute height
-    pred_img = frankot_chellappa(-grad_x, grad_y, progress_callback=progress_callback)
-    
-    # Cut to valid part if gradients were expanded
-    if not seamless:
-        height, width = normals_img.shape[1], normals_img.shape[2]
-        pred_img = pred_img[:height, :width]
-
-    # Expand single channel the three channels (RGB)
-    return np.stack([pred_img, pred_img, pred_img])
+import numpy as np
+
+try:
+    from . import utils_postprocess
+except ImportError:
+    # Cannot use . import when using as CLI
+    import utils_postprocess
+
+
+def normals_to_grad(normals_img):
+    return (normals_img[0] - 0.5) * 2, (normals_img[1] - 0.5) * 2
+
+
+def copy_flip(grad_x, grad_y):
+    """Concat 4 flipped copies of input gradients (makes them wrap).
+    Output is twice bigger in both dimensions."""
+
+    grad_x_top = np.hstack([grad_x, -np.flip(grad_x, axis=1)])
+    grad_x_bottom = np.hstack([np.flip(grad_x, axis=0), -np.flip(grad_x)])
+    new_grad_x = np.vstack([grad_x_top, grad_x_bottom])
+
+    grad_y_top = np.hstack([grad_y, np.flip(grad_y, axis=1)])
+    grad_y_bottom = np.hstack([-np.flip(grad_y, axis=0), -np.flip(grad_y)])
+    new_grad_y = np.vstack([grad_y_top, grad_y_bottom])
+
+    return new_grad_x, new_grad_y
+
+
+def frequency_grids(rows, cols):
+    """Returns the (ifftshift-ed) frequency grids used by Frankot-Chellappa."""
+
+    rows_scale = (np.arange(rows) - (rows // 2 + 1)) / (rows - rows % 2)
+    cols_scale = (np.arange(cols) - (cols // 2 + 1)) / (cols - cols % 2)
+
+    u_grid, v_grid = np.meshgrid(cols_scale, rows_scale)
+
+    u_grid = np.fft.ifftshift(u_grid)
+    v_grid = np.fft.ifftshift(v_grid)
+
+    return u_grid, v_grid
+
+
+def height_spectrum(grad_x_F, grad_y_F):
+    """Frankot-Chellappa height solve in the frequency domain, from the gradients
+    Fourier transforms."""
+
+    u_grid, v_grid = frequency_grids(*grad_x_F.shape)
+
+    nominator = (-1j * u_grid * grad_x_F) + (-1j * v_grid * grad_y_F)
+    denominator = (u_grid**2) + (v_grid**2) + 1e-16
+
+    Z_F = nominator / denominator
+    Z_F[0, 0] = 0.0
+
+    return Z_F
+
+
+def height_spectrum_inplace(grad_x_F, grad_y_F):
+    """Same as height_spectrum, but computed in place in 'grad_x_F' (which is returned,
+    'grad_y_F' is overwritten too) & with separable frequency grids, to avoid full size
+    temporaries."""
+
+    rows, cols = grad_x_F.shape
+    dtype = grad_x_F.real.dtype
+    rows_scale = (np.arange(rows) - (rows // 2 + 1)) / (rows - rows % 2)
+    cols_scale = (np.arange(cols) - (cols // 2 + 1)) / (cols - cols % 2)
+    u_grid = np.fft.ifftshift(cols_scale).astype(dtype)[None, :]
+    v_grid = np.fft.ifftshift(rows_scale).astype(dtype)[:, None]
+
+    # nominator
+    grad_x_F *= u_grid
+    grad_y_F *= v_grid
+    grad_x_F += grad_y_F
+    grad_x_F *= -1j
+
+    # denominator, by chunks of rows
+    for row in range(0, rows, 64):
+        grad_x_F[row:row+64] /= (u_grid**2) + (v_grid[row:row+64]**2) + 1e-16
+    grad_x_F[0, 0] = 0.0
+
+    return grad_x_F
+
+
+def spectrum_mips(Z_F, img_shape, seamless, mip_levels):
+    """Returns the (unnormalized) heights of the mip levels 1 to 'mip_levels' of a normal
+    map of shape 'img_shape' (C,H,W), each level half the size of the previous one, from
+    its height spectrum 'Z_F' (given by height_spectrum). Only the frequencies fitting
+    each level are kept & transformed back, so each level costs a small inverse FFT
+    instead of a resample of the full resolution height."""
+
+    rows, cols = Z_F.shape
+    mips = []
+    for level in range(1, mip_levels + 1):
+        mip_h, mip_w = max(1, img_shape[1] >> level), max(1, img_shape[2] >> level)
+        # Expanded spectra are twice the image size
+        mip_rows, mip_cols = (mip_h, mip_w) if seamless else (2 * mip_h, 2 * mip_w)
+
+        # Lowest positive & negative frequencies
+        row_freqs = np.r_[0:(mip_rows + 1) // 2, -(mip_rows // 2):0]
+        col_freqs = np.r_[0:(mip_cols + 1) // 2, -(mip_cols // 2):0]
+        mip_F = Z_F[np.ix_(row_freqs % rows, col_freqs % cols)]
+
+        # Sample at the center of the pixels each mip pixel covers (as a box filtered
+        # mip does) instead of at their first one
+        shift = 2j * np.pi * ((1 << level) - 1) / 2
+        mip_F *= np.exp(shift * row_freqs / rows)[:, None]
+        mip_F *= np.exp(shift * col_freqs / cols)[None, :]
+        mip = np.real(np.fft.ifft2(mip_F))
+        # Same amplitude as the full resolution inverse transform
+        mip *= (mip_rows * mip_cols) / (rows * cols)
+        mips.append(mip[:mip_h, :mip_w])
+    return mips
+
+
+def normalize_mips(mips, Z_min, Z_max):
+    """Normalizes the mip levels given by spectrum_mips with the range of the full
+    resolution height, so that all levels share the same scale (values overshooting it
+    because of the truncated spectra are clipped). Returns them as C,H,W read-only
+    views."""
+
+    normalized = []
+    for mip in mips:
+        mip -= Z_min
+        mip /= Z_max - Z_min
+        np.clip(mip, 0.0, 1.0, out=mip)
+        normalized.append(np.broadcast_to(mip, (3,) + mip.shape))
+    return normalized
+
+
+def frankot_chellappa(grad_x, grad_y, progress_callback=None):
+    """Frankot-Chellappa depth-from-gradient algorithm."""
+
+    if progress_callback is not None:
+        progress_callback(0,3)
+
+    grad_x_F = np.fft.fft2(grad_x)
+
+    if progress_callback is not None:
+        progress_callback(1,3)
+
+    grad_y_F = np.fft.fft2(grad_y)
+
+    if progress_callback is not None:
+        progress_callback(2,3)
+
+    Z = np.real(np.fft.ifft2(height_spectrum(grad_x_F, grad_y_F)))
+
+    if progress_callback is not None:
+        progress_callback(3,3)
+
+    return utils_postprocess.normalize_range(Z, out=Z)
+
+
+def get_gradients(normals_img, seamless):
+    """Returns the gradients to be integrated by frankot_chellappa, expanded to make them
+    wrap if 'seamless' is False."""
+
+    # Flip height axis
+    flip_img = np.flip(normals_img, axis=1)
+
+    # Get gradients from normal map
+    grad_x, grad_y = normals_to_grad(flip_img)
+    grad_x = np.flip(grad_x, axis=0)
+    grad_y = np.flip(grad_y, axis=0)
+
+    # If non-seamless chosen, expand gradients
+    if not seamless:
+        grad_x, grad_y = copy_flip(grad_x, grad_y)
+
+    return -grad_x, grad_y
+
+
+def gradients_spectra(normals_img, seamless, progress_callback=None):
+    """Returns the Fourier transforms of the gradients given by get_gradients. First step
+    of apply."""
+
+    if progress_callback is not None:
+        progress_callback(0, 3)
+    grad_x, grad_y = get_gradients(normals_img, seamless)
+    grad_x_F = np.fft.fft2(grad_x)
+    if progress_callback is not None:
+        progress_callback(1, 3)
+    grad_y_F = np.fft.fft2(grad_y)
+    if progress_callback is not None:
+        progress_callback(2, 3)
+    return grad_x_F, grad_y_F
+
+
+def spectra_to_height(grad_x_F, grad_y_F, img_shape, seamless, progress_callback=None,
+                      mip_levels=0):
+    """Solves the height of a normal map of shape 'img_shape' (C,H,W) from the gradients
+    spectra given by gradients_spectra (which are not modified). Second step of apply.
+    With 'mip_levels', returns a list of the height followed by its mip levels."""
+
+    Z_F = height_spectrum(grad_x_F, grad_y_F)
+    Z = np.real(np.fft.ifft2(Z_F))
+    mips = spectrum_mips(Z_F, img_shape, seamless, mip_levels)
+    del Z_F
+    if progress_callback is not None:
+        progress_callback(3, 3)
+    if mips:
+        mips = normalize_mips(mips, *utils_postprocess.min_max(Z))
+    pred_img = utils_postprocess.normalize_range(Z, out=Z)
+
+    # Cut to valid part if gradients were expanded
+    if not seamless:
+        height, width = img_shape[1], img_shape[2]
+        pred_img = pred_img[:height, :width]
+
+    # Expand single channel the three channels (RGB)
+    pred_img = np.stack([pred_img, pred_img, pred_img])
+    if mip_levels:
+        return [pred_img] + mips
+    return pred_img
+
+
+def estimate_memory(img_shape, seamless, low_memory=False):
+    """Returns an estimate (in bytes) of the peak memory used by apply for a normal map of
+    shape 'img_shape' (C,H,W), not counting the input image itself."""
+
+    # Gradients are expanded 4 times if not seamless
+    area = img_shape[1] * img_shape[2] * (1 if seamless else 4)
+    if low_memory:
+        # float32 gradients & their spectra (complex64 with numpy >= 2, complex128 before)
+        complex_size = np.fft.fft(np.zeros(1, dtype=np.float32)).itemsize
+        return area * (2 * 4 + 2 * complex_size)
+    # float64 gradients, spectra, frequency grids & solve temporaries
+    return area * (2 * 8 + 2 * 16 + 2 * 8 + 3 * 16 + 8)
+
+
+def apply_low_memory(normals_img, seamless, progress_callback, mip_levels=0):
+    """Same as apply, but computed in float32 & in place as much as possible."""
+
+    if progress_callback is not None:
+        progress_callback(0, 3)
+
+    # Gradients spectra, dropping each buffer as soon as it is not needed anymore
+    grad_x, grad_y = get_gradients(normals_img[0:2].astype(np.float32), seamless)
+    grad_x_F = np.fft.fft2(grad_x)
+    del grad_x
+    if progress_callback is not None:
+        progress_callback(1, 3)
+    grad_y_F = np.fft.fft2(grad_y)
+    del grad_y
+    if progress_callback is not None:
+        progress_callback(2, 3)
+
+    # Compute height
+    Z_F = height_spectrum_inplace(grad_x_F, grad_y_F)
+    del grad_x_F, grad_y_F
+    Z = np.real(np.fft.ifft2(Z_F))
+    mips = spectrum_mips(Z_F, normals_img.shape, seamless, mip_levels)
+    del Z_F
+    Z_min, Z_max = utils_postprocess.min_max(Z)
+
+    # Cut to valid part if gradients were expanded
+    if not seamless:
+        height, width = normals_img.shape[1], normals_img.shape[2]
+        Z = Z[:height, :width]
+    pred_img = ((Z - Z_min) / (Z_max - Z_min)).astype(np.float32)
+    if progress_callback is not None:
+        progress_callback(3, 3)
+
+    # Expand single channel the three channels (RGB), without copies
+    pred_img = np.broadcast_to(pred_img, (3,) + pred_img.shape)
+    if mip_levels:
+        return [pred_img] + normalize_mips(mips, Z_min, Z_max)
+    return pred_img
+
+
+def apply(normals_img, seamless, progress_callback, max_memory=None, mip_levels=0):
+    """Computes a height map from the given normal map. 'normals_img' must be a numpy array
+    in C,H,W format (with C as RGB). 'seamless' is a bool that should indicates if 'normals_img'
+    is seamless. If the estimated memory use exceeds 'max_memory' (in bytes), the height is
+    computed in float32 & in place (the returned array is then a read-only view). With
+    'mip_levels', returns a list of the height followed by that many mip levels (see
+    spectrum_mips)."""
+
+    if max_memory is not None and estimate_memory(normals_img.shape, seamless) > max_memory:
+        print("DeepBump Normals → Height : low memory mode")
+        if estimate_memory(normals_img.shape, seamless, True) > max_memory:
+            print("DeepBump Normals → Height : warning, the low memory mode still exceeds the memory budget")
+        return apply_low_memory(normals_img, seamless, progress_callback, mip_levels)
+
+    # Compute height
+    grad_x_F, grad_y_F = gradients_spectra(normals_img, seamless, progress_callback)
+    return spectra_to_height(
+        grad_x_F, grad_y_F, normals_img.shape, seamless, progress_callback, mip_levels
+    )
+
+
+async def apply_async(normals_img, seamless, executor=None, **kwargs):
+    """Same as apply, run on 'executor' (see utils_async) without blocking the asyncio
+    event loop. Returns a utils_async.Job, streaming the progress & giving the
+    height map once awaited."""
+
+    # asyncio is only imported by the services using it
+    try:
+        from . import utils_async
+    except ImportError:
+        # Cannot use . import when using as CLI
+        import utils_async
+
+    return await utils_async.submit(
+        lambda progress_callback: apply(normals_img, seamless, progress_callback, **kwargs),
+        executor,
+    )
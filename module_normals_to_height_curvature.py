@@ -0,0 +1,129 @@
+import numpy as np
+
+try:
+    from . import module_normals_to_height
+    from . import module_normals_to_curvature
+    from . import utils_postprocess
+except ImportError:
+    # Cannot use . import when using as CLI
+    import module_normals_to_height
+    import module_normals_to_curvature
+    import utils_postprocess
+
+
+def curvature_from_spectra(grad_x_F, grad_y_F, g_kernel):
+    """Computes the (unnormalized) curvature from the Fourier transforms of the gradients
+    given to frankot_chellappa. Derivative & gaussian blur are applied as filters in the
+    frequency domain, which matches the wrap-padded convolutions of
+    module_normals_to_curvature."""
+
+    rows, cols = grad_x_F.shape
+
+    # Gradients are (normals-0.5)*2 (with x negated), so the edges detected on the normal
+    # map red & green channels only differ by a scale factor (and the constant component,
+    # which the derivative kernel removes)
+    diff_kernel = np.array([-1, 0, 1])
+    edges_F = module_normals_to_curvature.kernel_spectrum(diff_kernel, cols)[None, :] * grad_x_F
+    edges_F += module_normals_to_curvature.kernel_spectrum(diff_kernel, rows)[:, None] * grad_y_F
+
+    # Blur curvature with separated filters
+    if g_kernel is not None:
+        edges_F *= module_normals_to_curvature.kernel_spectrum(g_kernel, cols)[None, :]
+        edges_F *= module_normals_to_curvature.kernel_spectrum(g_kernel, rows)[:, None]
+
+    return np.real(np.fft.ifft2(edges_F))
+
+
+def estimate_memory(img_shape, seamless, blur_radius):
+    """Returns an estimate (in bytes) of the peak memory used by apply for a normal map of
+    shape 'img_shape' (C,H,W), not counting the input image itself."""
+
+    # Same as the height, plus the curvature spectrum & its inverse transform
+    height_size = module_normals_to_height.estimate_memory(img_shape, seamless)
+    area = img_shape[1] * img_shape[2] * (1 if seamless else 4)
+    return height_size + area * 2 * 16
+
+
+def apply(normals_img, seamless, blur_radius, progress_callback, mip_levels=0):
+    """Computes both a height map & a curvature map from the given normal map, sharing the
+    gradients and their Fourier transforms. 'normals_img' must be a numpy array in C,H,W
+    format (with C as RGB). 'seamless' and 'blur_radius' are the same as in
+    module_normals_to_height and module_normals_to_curvature. Returns the (height,
+    curvature) pair, the height being a list of the height & its mip levels if
+    'mip_levels' is given (see module_normals_to_height.spectrum_mips).
+
+    When 'seamless' is False, the height uses mirrored gradients while the curvature
+    (like module_normals_to_curvature) wraps around the image borders, so the curvature
+    then needs its own transforms of the (smaller) wrapped gradients. The CLI only fuses
+    both outputs when 'seamless' is True, where everything is shared."""
+
+    if progress_callback is not None:
+        progress_callback(0, 4)
+
+    # Gradients Fourier transforms, shared by both outputs
+    grad_x, grad_y = module_normals_to_height.get_gradients(normals_img, seamless)
+    grad_x_F = np.fft.fft2(grad_x)
+    grad_y_F = np.fft.fft2(grad_y)
+    del grad_x, grad_y
+    if progress_callback is not None:
+        progress_callback(1, 4)
+
+    # Height
+    Z_F = module_normals_to_height.height_spectrum(grad_x_F, grad_y_F)
+    height = np.real(np.fft.ifft2(Z_F))
+    mips = module_normals_to_height.spectrum_mips(Z_F, normals_img.shape, seamless, mip_levels)
+    del Z_F
+    if mips:
+        mips = module_normals_to_height.normalize_mips(
+            mips, *utils_postprocess.min_max(height)
+        )
+    height = utils_postprocess.normalize_range(height, out=height)
+    if progress_callback is not None:
+        progress_callback(2, 4)
+
+    # Cut to valid part if gradients were expanded, the curvature needs the spectra of
+    # the wrapped gradients
+    if not seamless:
+        img_h, img_w = normals_img.shape[1], normals_img.shape[2]
+        height = height[:img_h, :img_w]
+        grad_x, grad_y = module_normals_to_height.get_gradients(normals_img, True)
+        grad_x_F = np.fft.fft2(grad_x)
+        grad_y_F = np.fft.fft2(grad_y)
+        del grad_x, grad_y
+
+    # Curvature, blur radius is relative to the input image size
+    g_kernel = module_normals_to_curvature.blur_kernel(normals_img.shape, blur_radius)
+    curvature = curvature_from_spectra(grad_x_F, grad_y_F, g_kernel)
+    if progress_callback is not None:
+        progress_callback(3, 4)
+
+    # Normalize to [0,1]
+    curvature = utils_postprocess.normalize_range(curvature, out=curvature)
+    if progress_callback is not None:
+        progress_callback(4, 4)
+
+    # Expand single channel the three channels (RGB)
+    height = np.stack([height, height, height])
+    if mip_levels:
+        height = [height] + mips
+    return height, np.stack([curvature, curvature, curvature])
+
+
+async def apply_async(normals_img, seamless, blur_radius, executor=None, **kwargs):
+    """Same as apply, run on 'executor' (see utils_async) without blocking the asyncio
+    event loop. Returns a utils_async.Job, streaming the progress & giving the
+    (height, curvature) maps once awaited."""
+
+    # asyncio is only imported by the services using it
+    try:
+        from . import utils_async
+    except ImportError:
+        # Cannot use . import when using as CLI
+        import utils_async
+
+    return await utils_async.submit(
+        lambda progress_callback: apply(
+            normals_img, seamless, blur_radius, progress_callback, **kwargs
+        ),
+        executor,
+    )
@@ -0,0 +1,12 @@
+import pathlib
+import pytest
+
+# The repository root is the Blender add-on package, whose __init__.py imports bpy : it
+# is collected as a plain directory, so that tests run outside of Blender
+ROOT = pathlib.Path(__file__).parent.parent
+
+
+def pytest_collect_directory(path, parent):
+    if path == ROOT:
+        return pytest.Dir.from_parent(parent, path=path)
+    return None
@@ -0,0 +1,71 @@
+import numpy as np
+
+# Imported directly, as the CLI does (see pytest.ini)
+import utils
+
+
+class MockPixels:
+    """Flat float pixels of a Blender image, with the bpy_prop_array bulk accessors."""
+
+    def __init__(self, values):
+        self.values = np.array(values, dtype=np.float32)
+
+    def foreach_get(self, buffer):
+        assert buffer.dtype == np.float32 and buffer.size == self.values.size
+        buffer[...] = self.values
+
+    def foreach_set(self, buffer):
+        assert buffer.size == self.values.size
+        self.values = np.array(buffer, dtype=np.float32)
+
+
+class MockImage:
+    """Blender image with 'size' (width, height), 'channels' & RGBA 'pixels' stored row by
+    row from the bottom."""
+
+    def __init__(self, width, height, values=None):
+        self.size = (width, height)
+        self.channels = 4
+        if values is None:
+            values = np.zeros(width * height * 4)
+        self.pixels = MockPixels(values)
+
+
+def flat_rgba(width, height):
+    """Returns distinct flat RGBA values, pixel (x, y) (y from the bottom) of channel c
+    being y*100 + x*10 + c."""
+
+    y, x, c = np.meshgrid(np.arange(height), np.arange(width), np.arange(4), indexing="ij")
+    return (y * 100 + x * 10 + c).reshape(-1).astype(np.float32)
+
+
+def test_bl_image_to_np_layout():
+    width, height = 3, 2
+    np_img = utils.bl_image_to_np(MockImage(width, height, flat_rgba(width, height)))
+
+    # C,H,W without alpha, first row being the top (last Blender) row
+    assert np_img.shape == (3, height, width)
+    for c in range(3):
+        for row in range(height):
+            for x in range(width):
+                assert np_img[c, row, x] == (height - 1 - row) * 100 + x * 10 + c
+
+
+def test_np_to_bl_image_layout():
+    width, height = 3, 2
+    np_img = np.random.rand(3, height, width).astype(np.float32)
+    bl_img = MockImage(width, height)
+    utils.np_to_bl_image(np_img, bl_img)
+
+    pixels = bl_img.pixels.values.reshape(height, width, 4)
+    for y in range(height):
+        for x in range(width):
+            assert np.array_equal(pixels[y, x, 0:3], np_img[:, height - 1 - y, x])
+            assert pixels[y, x, 3] == 1.0
+
+
+def test_round_trip():
+    np_img = np.random.rand(3, 5, 7).astype(np.float32)
+    bl_img = MockImage(7, 5)
+    utils.np_to_bl_image(np_img, bl_img)
+    assert np.array_equal(utils.bl_image_to_np(bl_img), np_img)
@@ -3,19 +3,19 @@ import numpy as np
 def bl_image_to_np(bl_img):
     """Converts a Blender image to a numpy C,H,W numpy array."""
 
-    # Convert to C,H,W numpy array
+    # Copy pixels straight into a float32 buffer (much faster than going through
+    # bl_img.pixels Python floats)
     width = bl_img.size[0]
     height = bl_img.size[1]
     channels = bl_img.channels
-    np_img = np.array(bl_img.pixels)
-    np_img = np.reshape(np_img, (channels, width, height), order='F')
-    np_img = np.transpose(np_img, (0, 2, 1))
+    pixels = np.empty(width * height * channels, dtype=np.float32)
+    bl_img.pixels.foreach_get(pixels)
 
-    # Flip height
-    np_img = np.flip(np_img, axis=1)
-
-    # Remove alpha
-    np_img = np_img[0:3]
+    # Pixels are stored row by row from the bottom, with interleaved channels : view them
+    # as H,W,C, flip height, remove alpha & transpose to C,H,W (no copies)
+    np_img = np.reshape(pixels, (height, width, channels))
+    np_img = np_img[::-1, :, 0:3]
+    np_img = np.transpose(np_img, (2, 0, 1))
 
     return np_img
 
@@ -23,13 +23,17 @@ def np_to_bl_pixels(np_img):
     """Converts a C,H,W numpy image array to an array of pixel suited for 
     blender internal images pixels."""
 
-    # Flip height
-    img = np.flip(np_img, axis=1)
-    # Add alpha channel
+    # Fill a preallocated H,W,RGBA float32 buffer in a single copy, flipping height
     height, width = np_img.shape[1], np_img.shape[2]
-    img = np.concatenate(
-        [img, np.ones((1, height, width))], axis=0)
-    # Flatten to array
-    pixels = np.transpose(img, (0, 2, 1)).flatten('F')
-    
-    return pixels
\ No newline at end of file
+    pixels = np.empty((height, width, 4), dtype=np.float32)
+    pixels[:, :, 0:3] = np.transpose(np_img[:, ::-1, :], (1, 2, 0))
+    # Add alpha channel
+    pixels[:, :, 3] = 1.0
+
+    # Flatten to array (no copy)
+    return np.reshape(pixels, -1)
+
+def np_to_bl_image(np_img, bl_img):
+    """Writes a C,H,W numpy image array to the pixels of the given Blender image."""
+
+    bl_img.pixels.foreach_set(np_to_bl_pixels(np_img))
@@ -0,0 +1,156 @@
+import asyncio
+import concurrent.futures
+import threading
+
+try:
+    from . import utils_inference
+except ImportError:
+    # Cannot use . import when using as CLI
+    import utils_inference
+
+# Executor used by the modules 'apply_async' when none is given, created on first use
+default_executor = None
+default_executor_lock = threading.Lock()
+
+
+class Job:
+    """A module 'apply' call running on an AsyncExecutor. Iterating over it ('async for')
+    yields its (current, total) progress until it is done, skipping intermediate values
+    if the consumer is slower than the progress. Awaiting it returns the 'apply' result.
+    'cancel' stops it at its next progress call (e.g. between tile batches)."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = None
+        self.progress = None
+        self.progress_changed = asyncio.Event()
+        self.cancelled = threading.Event()
+
+    def progress_callback(self, current, total):
+        # Called from the executor thread
+        if self.cancelled.is_set():
+            raise utils_inference.Cancelled()
+        self.loop.call_soon_threadsafe(self.set_progress, (current, total))
+
+    def set_progress(self, progress):
+        self.progress = progress
+        self.progress_changed.set()
+
+    def cancel(self):
+        """Stops the job, right when it starts if it is still queued. The job only ends
+        once its thread stopped, so that it keeps its executor slot until then."""
+
+        self.cancelled.set()
+
+    def done(self):
+        return self.future.done()
+
+    def __aiter__(self):
+        return self.progress_updates()
+
+    async def progress_updates(self):
+        # Progress is sent before the result (calls from the executor thread are run in
+        # order), so the last progress is always yielded
+        while True:
+            if not self.progress_changed.is_set():
+                if self.future.done():
+                    return
+                changed = asyncio.ensure_future(self.progress_changed.wait())
+                await asyncio.wait(
+                    [changed, self.future], return_when=asyncio.FIRST_COMPLETED
+                )
+                changed.cancel()
+                if not self.progress_changed.is_set():
+                    continue
+            self.progress_changed.clear()
+            yield self.progress
+
+    async def result(self):
+        """Returns the 'apply' result. Raises asyncio.CancelledError if the job was
+        cancelled, cancelling the awaiting task also cancels the job."""
+
+        try:
+            return await asyncio.shield(self.future)
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+        except utils_inference.Cancelled:
+            raise asyncio.CancelledError()
+
+    def __await__(self):
+        return self.result().__await__()
+
+
+class AsyncExecutor:
+    """Runs module 'apply' calls on 'max_workers' threads without blocking the asyncio
+    event loop. At most 'max_queued' jobs wait for a thread, submitting more waits for
+    one of them to start (backpressure). ONNX Runtime & numpy release the GIL, but each
+    model run already uses all cores by default, so more than one worker mostly helps
+    overlapping the non tiled steps of concurrent jobs."""
+
+    def __init__(self, max_workers=1, max_queued=8):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix="deepbump"
+        )
+        self.slots = None
+        self.max_jobs = max_workers + max_queued
+
+    async def submit(self, function):
+        """Runs 'function(progress_callback)' on the executor & returns its Job, once
+        there is room for it in the queue."""
+
+        # Created here, to be bound to the running event loop
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_jobs)
+        await self.slots.acquire()
+
+        loop = asyncio.get_running_loop()
+        job = Job(loop)
+
+        def run():
+            if job.cancelled.is_set():
+                raise utils_inference.Cancelled()
+            return function(job.progress_callback)
+
+        try:
+            job.future = loop.run_in_executor(self.executor, run)
+        except BaseException:
+            self.slots.release()
+            raise
+        job.future.add_done_callback(lambda _: self.slots.release())
+        return job
+
+    def shutdown(self, wait=True):
+        """Stops the worker threads, jobs not started yet are cancelled."""
+
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def configure(max_workers=1, max_queued=8):
+    """Replaces the default executor with one of the given limits (see AsyncExecutor)."""
+
+    global default_executor
+    with default_executor_lock:
+        if default_executor is not None:
+            default_executor.shutdown(wait=False)
+        default_executor = AsyncExecutor(max_workers, max_queued)
+    return default_executor
+
+
+def get_executor():
+    """Returns the default executor, creating it with the default limits on first use."""
+
+    global default_executor
+    with default_executor_lock:
+        if default_executor is None:
+            default_executor = AsyncExecutor()
+    return default_executor
+
+
+async def submit(function, executor=None):
+    """Runs 'function(progress_callback)' on 'executor' (the default one if None), see
+    AsyncExecutor.submit."""
+
+    if executor is None:
+        executor = get_executor()
+    return await executor.submit(function)
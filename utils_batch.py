@@ -0,0 +1,505 @@
+import hashlib
+import json
+import os
+import sys
+import time
+from multiprocessing import shared_memory
+
+# Image files picked up by batch runs
+IMAGE_EXTENSIONS = [
+    ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".tga", ".webp", ".npy"
+]
+
+# Suffix appended to input file names for each module output (same as the Blender add-on)
+OUTPUT_SUFFIXES = {
+    "color_to_normals": "_normals",
+    "normals_to_curvature": "_curvature",
+    "normals_to_height": "_height",
+    "lowres_to_highres": "_highres",
+}
+
+# Options used by all modules & changing their outputs (output bit depth, low memory
+# code paths), recorded along the module ones
+OUTPUT_OPTIONS = ["bit_depth", "max_memory"]
+
+# Suffixes of module options only changing how outputs are computed (parallelism), not
+# recorded so that changing them does not reprocess the inputs
+EXECUTION_OPTIONS_SUFFIXES = ("_workers", "_threads")
+
+# Modules inferring tiles, their progress_callback counting tiles
+TILED_MODULES = ["color_to_normals", "lowres_to_highres"]
+
+# Latency percentiles given in run reports
+PERCENTILES = [50, 95, 99]
+
+
+def list_inputs(in_dir):
+    """Returns the (sorted) paths of all images in 'in_dir' and its subdirectories,
+    relative to 'in_dir'."""
+
+    paths = []
+    for root, _, files in os.walk(in_dir):
+        for file in files:
+            if os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS:
+                paths.append(os.path.relpath(os.path.join(root, file), in_dir))
+    return sorted(paths)
+
+
+def parse_shard(shard):
+    """Parses a 'INDEX/COUNT' shard string to an (index, count) tuple."""
+
+    index, count = (int(value) for value in shard.split("/"))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"invalid shard '{shard}', INDEX must be in [0, COUNT)")
+    return index, count
+
+
+def in_shard(rel_path, shard_index, shard_count):
+    """Returns True if the input at 'rel_path' belongs to the given shard. Based on a
+    stable hash of the path, so all nodes agree on the split without coordination."""
+
+    key = rel_path.replace(os.sep, "/").encode("utf-8")
+    digest = hashlib.sha256(key).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count == shard_index
+
+
+def output_path(out_dir, rel_path, module):
+    """Returns the output path of 'module' for the input image at 'rel_path'."""
+
+    stem, ext = os.path.splitext(rel_path)
+    return os.path.join(out_dir, stem + OUTPUT_SUFFIXES[module] + ext)
+
+
+def file_hash(path):
+    """Returns the SHA-256 hex digest of the file content."""
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def job_options(modules, options):
+    """Returns the subset of 'options' (a dict of CLI options) used by 'modules' or
+    changing their outputs, leaving out the execution only ones."""
+
+    return {
+        name: value
+        for name, value in sorted(options.items())
+        if name in OUTPUT_OPTIONS
+        or (
+            any(name.startswith(module + "_") for module in modules)
+            and not name.endswith(EXECUTION_OPTIONS_SUFFIXES)
+        )
+    }
+
+
+class Manifest:
+    """Records each processed input with the settings & outputs it was processed with.
+    Stored as one JSON record per line, appended as soon as a job is done, so that an
+    interrupted run loses at most the jobs in progress (the last record wins when an
+    input was processed several times)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.file = None
+        self.ends_with_newline = True
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    self.ends_with_newline = line.endswith("\n")
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Partially written line from an interrupted run
+                        continue
+                    self.records[record["input"]] = record
+
+    def is_up_to_date(self, record):
+        """Returns True if 'record' matches the one stored for the same input & all its
+        outputs still exist."""
+
+        previous = self.records.get(record["input"])
+        if previous is None:
+            return False
+        for key in ["input_hash", "modules", "options", "model_hashes", "outputs"]:
+            if previous[key] != record[key]:
+                return False
+        return all(os.path.exists(path) for path in previous["outputs"].values())
+
+    def add(self, record):
+        """Stores 'record' & appends it to the manifest file."""
+
+        self.records[record["input"]] = record
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+            # Start a new line if the previous run was interrupted mid-write
+            if not self.ends_with_newline:
+                self.file.write("\n")
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def compact(self):
+        """Rewrites the manifest file with only the latest record of each input."""
+
+        self.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            for _, record in sorted(self.records.items()):
+                file.write(json.dumps(record) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def merge_manifests(paths, out_path):
+    """Merges the given (per shard) manifests into 'out_path'."""
+
+    merged = Manifest(out_path)
+    for path in paths:
+        merged.records.update(Manifest(path).records)
+    merged.compact()
+    return merged
+
+
+def write_report(path, report):
+    """Writes a JSON report, replacing any previous one atomically."""
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def timing_report(shard, images, processed, busy_time, start_time):
+    """Returns the timing report of a batch run. 'busy_time' is the sum of the processing
+    times of each image & 'start_time' the run start, as given by time.time()."""
+
+    end_time = time.time()
+    return {
+        "shards": [shard],
+        "images": images,
+        "processed": processed,
+        "skipped": images - processed,
+        "busy_time": busy_time,
+        "start_time": start_time,
+        "end_time": end_time,
+        "wall_time": end_time - start_time,
+        "images_per_second": processed / max(end_time - start_time, 1e-9),
+    }
+
+
+def merge_reports(reports):
+    """Merges the timing reports of several shards into a farm-wide summary. Wall time
+    spans from the earliest shard start to the latest shard end. Latency percentiles
+    are only given per shard (in 'shard_reports')."""
+
+    start_time = min(report["start_time"] for report in reports)
+    end_time = max(report["end_time"] for report in reports)
+    processed = sum(report["processed"] for report in reports)
+    tiles = sum(report.get("tiles", 0) for report in reports)
+    return {
+        "shards": [shard for report in reports for shard in report["shards"]],
+        "images": sum(report["images"] for report in reports),
+        "processed": processed,
+        "skipped": sum(report["skipped"] for report in reports),
+        "busy_time": sum(report["busy_time"] for report in reports),
+        "start_time": start_time,
+        "end_time": end_time,
+        "wall_time": end_time - start_time,
+        "images_per_second": processed / max(end_time - start_time, 1e-9),
+        "tiles": tiles,
+        "tiles_per_second": tiles / max(end_time - start_time, 1e-9),
+        "peak_rss": max(report.get("peak_rss") or 0 for report in reports) or None,
+        "shard_reports": reports,
+    }
+
+
+def peak_rss():
+    """Returns the peak resident memory of this process in bytes, or None where it is
+    not available (Windows)."""
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def percentile(values, percent):
+    """Returns the 'percent' percentile of 'values', interpolated between the closest
+    ranks (same as numpy.percentile)."""
+
+    values = sorted(values)
+    position = (len(values) - 1) * percent / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+class JobStats:
+    """Times the stages of a batch job ('read', each module run by run_modules, 'write')
+    & counts the tiles inferred by tiled modules, from their progress_callback. 'start'
+    & 'progress' are given to run_modules as its stage & progress callbacks, progress
+    being forwarded to 'progress_callback'."""
+
+    def __init__(self, progress_callback=None):
+        import utils_inference
+
+        self.progress_callback = progress_callback
+        self.stages = {}
+        self.stage = None
+        self.stage_start = None
+        self.tiles = 0
+        self.constant_preds_stats = dict(utils_inference.constant_preds_stats)
+
+    def start(self, stage):
+        """Ends the current stage & starts 'stage' (None to stop). Returns the stage
+        that was running, so that nested stages can resume it."""
+
+        now = time.perf_counter()
+        previous = self.stage
+        if previous is not None:
+            self.stages[previous] = self.stages.get(previous, 0.0) + now - self.stage_start
+        self.stage = stage
+        self.stage_start = now
+        return previous
+
+    def progress(self, current, total):
+        # Tiled modules report each tile, the last call giving their amount
+        if self.stage in TILED_MODULES and current == total:
+            self.tiles += total
+        if self.progress_callback is not None:
+            self.progress_callback(current, total)
+
+    def result(self):
+        """Stops the current stage & returns the job statistics, as sent back by batch
+        worker processes."""
+
+        import utils_inference
+
+        self.start(None)
+        return {
+            "stages": self.stages,
+            "tiles": self.tiles,
+            "flat_tiles": {
+                name: value - self.constant_preds_stats[name]
+                for name, value in utils_inference.constant_preds_stats.items()
+            },
+            "peak_rss": peak_rss(),
+        }
+
+
+class RunReport:
+    """Summarizes the JobStats of a batch run : throughput, latency percentiles of the
+    images & of each stage, peak memory & cache hit rates (manifest & flat tiles).
+    Written as a JSON report (extending timing_report) and/or as Prometheus metrics for
+    the node exporter textfile collector, both rewritten at most every 'interval'
+    seconds while the run is in progress."""
+
+    def __init__(self, shard, images, report_path=None, textfile_path=None, interval=5.0):
+        self.shard = shard
+        self.images = images
+        self.report_path = report_path
+        self.textfile_path = textfile_path
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_write = 0.0
+        self.latencies = []
+        self.stage_latencies = {}
+        self.processed = 0
+        self.skipped = 0
+        self.tiles = 0
+        self.flat_tiles = {"hits": 0, "misses": 0}
+        self.peak_rss = peak_rss()
+
+    def add(self, stats):
+        """Adds the JobStats result of a processed image, returns its latency."""
+
+        latency = sum(stats["stages"].values())
+        self.latencies.append(latency)
+        for stage, elapsed in stats["stages"].items():
+            self.stage_latencies.setdefault(stage, []).append(elapsed)
+        self.processed += 1
+        self.tiles += stats["tiles"]
+        for name in self.flat_tiles:
+            self.flat_tiles[name] += stats["flat_tiles"][name]
+        self.peak_rss = max(filter(None, [self.peak_rss, stats["peak_rss"], peak_rss()]),
+                            default=None)
+        self.write()
+        return latency
+
+    def skip(self):
+        """Counts an input skipped as up to date in the manifest."""
+
+        self.skipped += 1
+        self.write()
+
+    def summary(self, done=False):
+        report = timing_report(
+            self.shard, self.images, self.processed, sum(self.latencies), self.start_time
+        )
+        wall_time = max(report["wall_time"], 1e-9)
+        flat_tiles = self.flat_tiles["hits"] + self.flat_tiles["misses"]
+        report.update({
+            "done": done,
+            "skipped": self.skipped,
+            "pending": self.images - self.processed - self.skipped,
+            "tiles": self.tiles,
+            "tiles_per_second": self.tiles / wall_time,
+            "latency": self.percentiles(self.latencies),
+            "stages": {
+                stage: self.percentiles(latencies)
+                for stage, latencies in self.stage_latencies.items()
+            },
+            "peak_rss": self.peak_rss,
+            "manifest_hit_rate": self.skipped / max(self.processed + self.skipped, 1),
+            "flat_tiles": flat_tiles,
+            "flat_tile_rate": flat_tiles / max(self.tiles, 1),
+            "constant_preds_hit_rate": self.flat_tiles["hits"] / max(flat_tiles, 1),
+        })
+        return report
+
+    @staticmethod
+    def percentiles(latencies):
+        summary = {f"p{percent}": None for percent in PERCENTILES}
+        if latencies:
+            summary = {
+                f"p{percent}": percentile(latencies, percent) for percent in PERCENTILES
+            }
+        summary.update({"sum": sum(latencies), "count": len(latencies)})
+        return summary
+
+    def write(self, done=False):
+        """Writes the report & metrics files, if 'interval' elapsed since the last
+        write (or if 'done')."""
+
+        if not done and time.time() - self.last_write < self.interval:
+            return
+        self.last_write = time.time()
+        report = self.summary(done)
+        if self.report_path is not None:
+            write_report(self.report_path, report)
+        if self.textfile_path is not None:
+            write_textfile(self.textfile_path, prometheus_metrics(report))
+
+
+def prometheus_metrics(report):
+    """Returns the run report as metrics in the Prometheus text exposition format,
+    labelled with the shard."""
+
+    labels = f'shard="{report["shards"][0]}"'
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP deepbump_batch_{name} {help_text}")
+        lines.append(f"# TYPE deepbump_batch_{name} {kind}")
+        for suffix, extra_labels, value in samples:
+            if value is not None:
+                lines.append(
+                    f"deepbump_batch_{name}{suffix}{{{labels}{extra_labels}}} {value}"
+                )
+
+    def summary_samples(latencies, extra_labels=""):
+        samples = [
+            ("", f'{extra_labels},quantile="{percent / 100}"', latencies[f"p{percent}"])
+            for percent in PERCENTILES
+        ]
+        samples.append(("_sum", extra_labels, latencies["sum"]))
+        samples.append(("_count", extra_labels, latencies["count"]))
+        return samples
+
+    metric("running", "gauge", "Whether the batch run is in progress.",
+           [("", "", int(not report["done"]))])
+    metric("images", "gauge", "Images to process in the batch run.",
+           [("", "", report["images"])])
+    metric("images_processed_total", "counter", "Images processed.",
+           [("", "", report["processed"])])
+    metric("images_skipped_total", "counter", "Images skipped as up to date in the manifest.",
+           [("", "", report["skipped"])])
+    metric("images_per_second", "gauge", "Images processed per second since the start.",
+           [("", "", report["images_per_second"])])
+    metric("tiles_total", "counter", "Tiles processed by tiled modules.",
+           [("", "", report["tiles"])])
+    metric("tiles_per_second", "gauge", "Tiles processed per second since the start.",
+           [("", "", report["tiles_per_second"])])
+    metric("flat_tiles_total", "counter", "Flat tiles given a constant tile prediction.",
+           [("", "", report["flat_tiles"])])
+    metric("image_seconds", "summary", "Processing time of each image.",
+           summary_samples(report["latency"]))
+    metric("stage_seconds", "summary", "Processing time of each stage of an image.", [
+        sample
+        for stage, latencies in report["stages"].items()
+        for sample in summary_samples(latencies, f',stage="{stage}"')
+    ])
+    metric("peak_rss_bytes", "gauge", "Peak resident memory of the run processes.",
+           [("", "", report["peak_rss"])])
+    metric("manifest_hit_rate", "gauge", "Share of the inputs skipped as up to date.",
+           [("", "", report["manifest_hit_rate"])])
+    metric("constant_preds_hit_rate", "gauge",
+           "Share of the flat tiles whose constant prediction was cached.",
+           [("", "", report["constant_preds_hit_rate"])])
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path, text):
+    """Writes a Prometheus textfile atomically, so the collector never reads a partial
+    file (the temporary file does not end with .prom, so it is ignored)."""
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+class SharedArray:
+    """A numpy array stored in a shared memory block, so that batch worker processes can
+    read & write it without it being pickled. Workers attach to it from its descriptor,
+    only the process that created it unlinks the block."""
+
+    def __init__(self, shm, shape, dtype, owner):
+        import numpy as np
+
+        self.shm = shm
+        self.owner = owner
+        self.array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, shape, dtype):
+        import numpy as np
+
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        return cls(shm, shape, dtype, True)
+
+    @classmethod
+    def from_array(cls, array):
+        shared = cls.create(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, descriptor):
+        name, shape, dtype = descriptor
+        return cls(shared_memory.SharedMemory(name=name), shape, dtype, False)
+
+    def descriptor(self):
+        """Returns the (name, shape, dtype) tuple to send to other processes."""
+
+        return (self.shm.name, self.array.shape, self.array.dtype.str)
+
+    def close(self):
+        # Views must be released before the block can be closed
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
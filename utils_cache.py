@@ -0,0 +1,77 @@
+import collections
+import hashlib
+import threading
+import numpy as np
+
+
+def pixels_hash(img):
+    """Returns a hex digest of the image pixels (& shape), used to detect edited images."""
+
+    digest = hashlib.blake2b(str(img.shape).encode(), digest_size=16)
+    # Hash channel by channel, so that non contiguous views are only copied one channel
+    # at a time
+    for channel in img:
+        digest.update(np.ascontiguousarray(channel, dtype=np.float32))
+    return digest.hexdigest()
+
+
+def value_size(value):
+    """Returns the size in bytes of the numpy arrays in 'value' (an array or a tuple)."""
+
+    if isinstance(value, tuple):
+        return sum(value_size(item) for item in value)
+    return value.nbytes
+
+
+class LRUCache:
+    """Thread safe cache of numpy arrays (or tuples of arrays), evicting the least recently
+    used entries once the total size exceeds 'max_size' (in bytes). Cached arrays are made
+    read-only, as they may be given back to several callers."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value stored for 'key', or None."""
+
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Stores 'value' for 'key' & returns it. Values bigger than the cache are not
+        stored."""
+
+        size = value_size(value)
+        if size > self.max_size:
+            return value
+        for array in value if isinstance(value, tuple) else (value,):
+            array.flags.writeable = False
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= value_size(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += size
+            self.evict()
+        return value
+
+    def resize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            self.evict()
+
+    def evict(self):
+        while self.size > self.max_size:
+            _, value = self.entries.popitem(last=False)
+            self.size -= value_size(value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -1,24 +1,79 @@
+import threading
+import weakref
 import numpy as np
 
+try:
+    from . import utils_cache
+    from . import utils_profile
+except ImportError:
+    # Cannot use . import when using as CLI
+    import utils_cache
+    import utils_profile
+
+# ONNX Runtime session options (onnxruntime.SessionOptions attributes) used when models
+# are loaded, e.g. enable_cpu_mem_arena, enable_mem_pattern or intra_op_num_threads.
+# Options not given keep the ONNX Runtime defaults (or the machine profile ones).
+session_options = {}
+
+# Tiles inferred per model run, keyed by model session (from the machine profile).
+# Entries go away with their session
+session_batch_sizes = weakref.WeakKeyDictionary()
+
+# Predictions of constant tiles, keyed by model session & tile value (see constant_pred).
+# Bounded, as long runs (batch, daemon) can meet any amount of colors & each upscaled
+# prediction takes 12 MB
+CONSTANT_PREDS_MAX_SIZE = 64 << 20
+constant_preds = utils_cache.LRUCache(CONSTANT_PREDS_MAX_SIZE)
+constant_preds_lock = threading.Lock()
+
+# Flat tiles given a cached constant prediction ('hits') or a new one ('misses')
+constant_preds_stats = {'hits': 0, 'misses': 0}
+
+
+class Cancelled(Exception):
+    '''Can be raised from a progress_callback to stop the processing.'''
+
+
+def create_session(model_path, tuning=None):
+    '''Returns an ONNX Runtime CPU session for the given model. Threads & batch size come
+    from tuning (a dict like the machine profile entries, see utils_profile), or from the
+    machine profile if not given. session_options are applied last.'''
+
+    # onnxruntime is only imported once a model is needed
+    import onnxruntime as ort
+
+    # Disable MS telemetry
+    ort.disable_telemetry_events()
+
+    if tuning is None:
+        tuning = utils_profile.model_profile(model_path)
+    options = ort.SessionOptions()
+    for name in ['intra_op_num_threads', 'inter_op_num_threads']:
+        if name in tuning:
+            setattr(options, name, tuning[name])
+    if tuning.get('inter_op_num_threads', 1) > 1:
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    for name, value in session_options.items():
+        setattr(options, name, value)
+
+    ort_session = ort.InferenceSession(
+        model_path, sess_options=options, providers=["CPUExecutionProvider"]
+    )
+    session_batch_sizes[ort_session] = tuning.get('batch_size', 1)
+    return ort_session
+
 
 def pad(img, left, right, top, bottom):
     return np.pad(img, ((0, 0), (top, bottom), (left, right)), mode='wrap')
 
 
-def tiles_split(img, tile_size, stride_size):
-    '''Returns list of tiles from the given image and the padding used to fit the tiles
-     in it. Input image must have dimension C,H,W.'''
+def tiles_paddings(img_size, tile_size, stride_size):
+    '''Returns the padding tiles_split uses to fit the tiles in an image of size
+    img_size (H,W).'''
 
     tile_h, tile_w = tile_size
     stride_h, stride_w = stride_size
-    img_h, img_w = img.shape[1], img.shape[2]
-
-    # stride must be even
-    assert (stride_h % 2 == 0) and (stride_w % 2 == 0)
-    # stride must be greater or equal than half tile
-    assert (stride_h >= tile_h/2) and (stride_w >= tile_w/2)
-    # stride must be smaller or equal tile size
-    assert (stride_h <= tile_h) and (stride_w <= tile_w)
+    img_h, img_w = img_size
 
     # find total height & width padding sizes
     pad_h, pad_w = 0, 0
@@ -41,6 +96,26 @@ def tiles_split(img, tile_size, stride_size):
     pad_right = pad_left if pad_w % 2 == 0 else pad_left+1
     pad_top = pad_h//2 + stride_h
     pad_bottom = pad_top if pad_h % 2 == 0 else pad_top+1
+
+    return pad_left, pad_right, pad_top, pad_bottom
+
+
+def tiles_split(img, tile_size, stride_size):
+    '''Returns list of tiles from the given image and the padding used to fit the tiles
+     in it. Input image must have dimension C,H,W.'''
+
+    tile_h, tile_w = tile_size
+    stride_h, stride_w = stride_size
+
+    # stride must be even
+    assert (stride_h % 2 == 0) and (stride_w % 2 == 0)
+    # stride must be greater or equal than half tile
+    assert (stride_h >= tile_h/2) and (stride_w >= tile_w/2)
+    # stride must be smaller or equal tile size
+    assert (stride_h <= tile_h) and (stride_w <= tile_w)
+
+    pad_left, pad_right, pad_top, pad_bottom = tiles_paddings(
+        img.shape[1:3], tile_size, stride_size)
     img = pad(img, pad_left, pad_right, pad_top, pad_bottom)
     img_h, img_w = img.shape[1], img.shape[2]
 
@@ -57,21 +132,135 @@ def tiles_split(img, tile_size, stride_size):
     return tiles, (pad_left, pad_right, pad_top, pad_bottom)
 
 
-def tiles_infer(tiles, ort_session, progress_callback=None):
+def seamless_positions(size, stride_size):
+    '''Returns the start of the tiles along an axis of the given size, for
+    tiles_split_seamless : as few tiles as possible, evenly spread, none further apart
+    than stride_size.'''
+
+    count = -(-size // stride_size)
+    return [round(idx*size / count) for idx in range(count)]
+
+
+def tiles_split_seamless(img, tile_size, stride_size):
+    '''Same as tiles_split, but treating the image as a torus (for seamless textures) :
+    tiles wrap around the image borders instead of covering an extra padding ring, so
+    fewer tiles are needed & the merged output stays seamless. Returns the tiles and the
+    (rows, columns) starts of the tiles, to be given to SeamlessTilesMerger.'''
+
+    tile_h, tile_w = tile_size
+    stride_h, stride_w = stride_size
+    img_h, img_w = img.shape[1], img.shape[2]
+    positions = (
+        seamless_positions(img_h, stride_h),
+        seamless_positions(img_w, stride_w),
+    )
+
+    # only pad the bottom & right borders, for tiles wrapping around them
+    img = pad(img, 0, tile_w, 0, tile_h)
+    tiles = []
+    for h_from in positions[0]:
+        for w_from in positions[1]:
+            tiles.append(img[:, h_from:h_from+tile_h, w_from:w_from+tile_w])
+
+    return tiles, positions
+
+
+def flat_tiles(tiles, threshold):
+    '''Returns, for each tile, whether its variance (highest of its channels) is below
+    threshold.'''
+
+    return [float(np.max(np.var(tile, axis=(1, 2)))) < threshold for tile in tiles]
+
+
+def constant_pred(tile, ort_session):
+    '''Returns the model prediction for a constant tile of the mean value of tile
+    (quantized to 8 bits). Cached per value & model (see constant_preds), the returned
+    array must not be modified.'''
+
+    value = np.round(np.mean(tile, axis=(1, 2)) * 255) / 255
+    key = (id(ort_session), tuple(value))
+    pred = constant_preds.get(key)
+    with constant_preds_lock:
+        constant_preds_stats['misses' if pred is None else 'hits'] += 1
+    if pred is None:
+        const_tile = np.empty((1,) + tile.shape, dtype=np.float32)
+        const_tile[0] = value[:, None, None]
+        pred = constant_preds.put(key, ort_session.run(None, {'input': const_tile})[0][0])
+    return pred
+
+
+def output_shape(ort_session, tile):
+    '''Returns the shape of the model prediction for a single tile.'''
+
+    shape = ort_session.get_outputs()[0].shape[1:]
+    if all(isinstance(dim, int) for dim in shape):
+        return tuple(shape)
+    # Dynamic output size, infer once to get it
+    return ort_session.run(None, {'input': tile[None].astype(np.float32)})[0].shape[1:]
+
+
+def tiles_infer(tiles, ort_session, progress_callback=None, tile_callback=None,
+                flat=None, batch_size=None):
     '''Infer each tile with the given model. progress_callback will be called with 
     arguments : current tile idx and total tiles amount (used to show progress on 
-    cursor in Blender).'''
+    cursor in Blender). Predictions are written straight into the returned (N,C,H,W)
+    array. If tile_callback is given, it is called with each tile idx and prediction
+    instead (the prediction buffer is reused, so it is only valid during the call). If
+    flat is given (as returned by flat_tiles), flat tiles get the prediction of a
+    constant tile instead of being inferred.
+
+    Tiles are inferred batch_size at a time (by default, the machine profile one).
+    Model inputs & outputs are bound to preallocated buffers (IOBinding), so that no
+    tensor is allocated per batch.'''
 
-    pred_tiles = []
     tiles_nb = len(tiles)
     if progress_callback is not None:
         progress_callback(0, tiles_nb)
-
-    for i in range(tiles_nb):
-        if progress_callback is not None:
-            progress_callback(i+1, tiles_nb)
-        pred = ort_session.run(None, {'input': tiles[i:i+1]})[0][0]
-        pred_tiles.append(pred)
+    if tiles_nb == 0:
+        return []
+    if batch_size is None:
+        batch_size = session_batch_sizes.get(ort_session, 1)
+    batch_size = max(1, min(batch_size, tiles_nb))
+
+    # Tiles are copied into the (bound) input buffer, predictions are written straight
+    # into the returned array if possible, to a reused batch buffer otherwise
+    pred_shape = output_shape(ort_session, tiles[0])
+    batch_preds = np.empty((batch_size,) + pred_shape, dtype=np.float32)
+    if tile_callback is None:
+        pred_tiles = np.empty((tiles_nb,) + pred_shape, dtype=np.float32)
+    else:
+        pred_tiles = []
+    input_buffer = np.empty((batch_size,) + tiles[0].shape, dtype=np.float32)
+    binding = ort_session.io_binding()
+    output_name = ort_session.get_outputs()[0].name
+
+    for start in range(0, tiles_nb, batch_size):
+        end = min(start+batch_size, tiles_nb)
+        for i in range(start, end):
+            if progress_callback is not None:
+                progress_callback(i+1, tiles_nb)
+
+        # Infer the tiles of the batch that are not flat
+        inferred = [i for i in range(start, end) if flat is None or not flat[i]]
+        direct = tile_callback is None and len(inferred) == end-start
+        out = pred_tiles[start:end] if direct else batch_preds[:len(inferred)]
+        if inferred:
+            for j, i in enumerate(inferred):
+                np.copyto(input_buffer[j], tiles[i])
+            binding.bind_cpu_input('input', input_buffer[:len(inferred)])
+            binding.bind_output(output_name, 'cpu', 0, np.float32, out.shape,
+                                out.ctypes.data)
+            ort_session.run_with_iobinding(binding)
+        if direct:
+            continue
+
+        preds = dict(zip(inferred, out))
+        for i in range(start, end):
+            pred = preds[i] if i in preds else constant_pred(tiles[i], ort_session)
+            if tile_callback is not None:
+                tile_callback(i, pred)
+            else:
+                pred_tiles[i] = pred
     return pred_tiles
 
 
@@ -150,9 +339,10 @@ def scaling_mask(side_length):
     return 2*scaling
 
 
-def tiles_merge(tiles, stride_size, img_size, paddings):
-    '''Merges the list of tiles into one image. img_size is the original size, before 
-    padding.'''
+def tiles_merge(tiles, stride_size, img_size, paddings, dtype=np.float64):
+    '''Merges the list (or N,C,H,W array) of tiles into one image. img_size is the
+    original size, before padding. dtype is the merged image type, float32 halves the
+    memory traffic (merging is memory bound) at the cost of float32 rounding.'''
 
     _, tile_h, tile_w = tiles[0].shape
     pad_left, pad_right, pad_top, pad_bottom = paddings
@@ -167,25 +357,233 @@ def tiles_merge(tiles, stride_size, img_size, paddings):
     # stride must be smaller or equal tile size
     assert (stride_h <= tile_h) and (stride_w <= tile_w)
 
-    merged = np.zeros((img_size[0], height, width))
-    mask = generate_mask((tile_h, tile_w), stride_size)
+    merged = np.zeros((img_size[0], height, width), dtype=dtype)
+    mask = generate_mask((tile_h, tile_w), stride_size).astype(dtype)
 
     h_range = ((height-tile_h) // stride_h) + 1
     w_range = ((width-tile_w) // stride_w) + 1
 
+    # Merging is memory bound : weight tiles in a single reused buffer, small enough to
+    # stay in cache, instead of allocating a temporary per tile
+    weighted = np.empty((img_size[0], tile_h, tile_w), dtype=dtype)
     for h in range(0, h_range):
         for w in range(0, w_range):
             h_from, h_to = h*stride_h, h*stride_h + tile_h
             w_from, w_to = w*stride_w, w*stride_w + tile_w
-            merged[:, h_from:h_to, w_from:w_to] += tiles[0]*mask
-            del tiles[0]
+            np.multiply(tiles[h*w_range+w], mask, out=weighted)
+            merged[:, h_from:h_to, w_from:w_to] += weighted
 
     return merged[:, pad_top:-pad_bottom, pad_left:-pad_right]
 
 
+def changed_tiles(tiles, prev_tiles):
+    '''Returns, for each tile, whether it differs from the tile at the same index in
+    prev_tiles.'''
+
+    return [not np.array_equal(tile, prev_tile) for tile, prev_tile in zip(tiles, prev_tiles)]
+
+
+def tiles_merge_region(tiles, stride_size, padded_size, region, dtype=np.float64):
+    '''Merges the tiles overlapping region ((h_from, h_to), (w_from, w_to), in padded
+    image coordinates) the same way tiles_merge does, only returning that region.
+    padded_size is the padded image size (H,W).'''
+
+    _, tile_h, tile_w = tiles[0].shape
+    stride_h, stride_w = stride_size
+    (r_from, r_to), (c_from, c_to) = region
+    h_range = ((padded_size[0]-tile_h) // stride_h) + 1
+    w_range = ((padded_size[1]-tile_w) // stride_w) + 1
+
+    merged = np.zeros((tiles[0].shape[0], r_to-r_from, c_to-c_from), dtype=dtype)
+    mask = generate_mask((tile_h, tile_w), stride_size).astype(dtype)
+
+    # only visit the tiles overlapping the region : tile h covers [h*stride, h*stride+tile)
+    h_first = max(0, (r_from-tile_h) // stride_h + 1)
+    h_last = min(h_range, -(-r_to // stride_h))
+    w_first = max(0, (c_from-tile_w) // stride_w + 1)
+    w_last = min(w_range, -(-c_to // stride_w))
+
+    for h in range(h_first, h_last):
+        h_from, h_to = max(h*stride_h, r_from), min(h*stride_h + tile_h, r_to)
+        for w in range(w_first, w_last):
+            w_from, w_to = max(w*stride_w, c_from), min(w*stride_w + tile_w, c_to)
+            # part of the tile inside the region
+            tile_rows = slice(h_from-h*stride_h, h_to-h*stride_h)
+            tile_cols = slice(w_from-w*stride_w, w_to-w*stride_w)
+            merged[:, h_from-r_from:h_to-r_from, w_from-c_from:w_to-c_from] += \
+                tiles[h*w_range+w][:, tile_rows, tile_cols]*mask[tile_rows, tile_cols]
+
+    return merged
+
+
+class TilesMerger:
+    '''Merges tiles one at a time into the output image, as they are predicted, so that
+    predicted tiles do not need to be kept in memory. Same arguments as tiles_merge,
+    with img_size the original size, before padding.'''
+
+    def __init__(self, tile_size, stride_size, img_size, paddings, dtype=np.float64):
+        tile_h, tile_w = tile_size
+        stride_h, stride_w = stride_size
+        pad_left, pad_right, pad_top, pad_bottom = paddings
+        height = img_size[1] + pad_top + pad_bottom
+        width = img_size[2] + pad_left + pad_right
+
+        self.tile_size = tile_size
+        self.stride_size = stride_size
+        self.paddings = paddings
+        self.w_range = ((width-tile_w) // stride_w) + 1
+        self.merged = np.zeros((img_size[0], height, width), dtype=dtype)
+        self.mask = generate_mask(tile_size, stride_size).astype(dtype)
+        self.weighted = np.empty((img_size[0],) + tuple(tile_size), dtype=dtype)
+
+    def add(self, idx, tile):
+        '''Adds the tile at index idx (in tiles_split order).'''
+
+        h, w = idx // self.w_range, idx % self.w_range
+        h_from, h_to = h*self.stride_size[0], h*self.stride_size[0] + self.tile_size[0]
+        w_from, w_to = w*self.stride_size[1], w*self.stride_size[1] + self.tile_size[1]
+        np.multiply(tile, self.mask, out=self.weighted)
+        self.merged[:, h_from:h_to, w_from:w_to] += self.weighted
+
+    def result(self):
+        '''Returns the merged image, cropped to the original size.'''
+
+        pad_left, pad_right, pad_top, pad_bottom = self.paddings
+        return self.merged[:, pad_top:-pad_bottom, pad_left:-pad_right]
+
+    def final_rows(self, idx):
+        '''Returns the amount of rows of the result that no tile after the one at index
+        idx changes (tiles are added row by row).'''
+
+        height = self.merged.shape[1]
+        h_range = ((height-self.tile_size[0]) // self.stride_size[0]) + 1
+        h, w = idx // self.w_range, idx % self.w_range
+
+        # Rows above the next tiles row are final once the current tiles row is complete
+        if w != self.w_range-1:
+            rows = h*self.stride_size[0]
+        elif h != h_range-1:
+            rows = (h+1)*self.stride_size[0]
+        else:
+            rows = height
+
+        pad_top, pad_bottom = self.paddings[2], self.paddings[3]
+        return min(max(rows-pad_top, 0), height-pad_top-pad_bottom)
+
+
+def wrap_segments(start, length, size):
+    '''Splits the range [start, start+length) of a torus axis of the given size into
+    (to_from, to_to, from_from, from_to) segments, to_ in the image & from_ in the
+    range.'''
+
+    segments = []
+    offset = 0
+    while offset < length:
+        to_from = (start+offset) % size
+        count = min(length-offset, size-to_from)
+        segments.append((to_from, to_from+count, offset, offset+count))
+        offset += count
+    return segments
+
+
+class SeamlessTilesMerger:
+    '''Merges the tiles of tiles_split_seamless one at a time, wrapping them around the
+    image borders. As tiles are not evenly strided, the weighted sum is divided by the
+    sum of the mask weights covering each pixel. Same arguments as TilesMerger, with the
+    tiles positions instead of the paddings.'''
+
+    def __init__(self, tile_size, stride_size, img_size, positions, dtype=np.float64):
+        self.tile_size = tile_size
+        self.positions = positions
+        self.merged = np.zeros(img_size, dtype=dtype)
+        self.weights = np.zeros(img_size[1:3], dtype=dtype)
+        self.mask = generate_mask(tile_size, stride_size).astype(dtype)
+        self.weighted = np.empty((img_size[0],) + tuple(tile_size), dtype=dtype)
+        self.normalized = False
+
+    def add(self, idx, tile):
+        '''Adds the tile at index idx (in tiles_split_seamless order).'''
+
+        w_range = len(self.positions[1])
+        h_from = self.positions[0][idx // w_range]
+        w_from = self.positions[1][idx % w_range]
+        np.multiply(tile, self.mask, out=self.weighted)
+        for to_h, to_h_end, h, h_end in wrap_segments(h_from, self.tile_size[0],
+                                                      self.merged.shape[1]):
+            for to_w, to_w_end, w, w_end in wrap_segments(w_from, self.tile_size[1],
+                                                          self.merged.shape[2]):
+                self.merged[:, to_h:to_h_end, to_w:to_w_end] += (
+                    self.weighted[:, h:h_end, w:w_end])
+                self.weights[to_h:to_h_end, to_w:to_w_end] += self.mask[h:h_end, w:w_end]
+
+    def result(self):
+        '''Returns the merged image, once all tiles are added (normalized in place).'''
+
+        if not self.normalized:
+            self.merged /= self.weights
+            self.normalized = True
+        return self.merged
+
+    def final_rows(self, idx):
+        '''Same as TilesMerger.final_rows. The first rows are only final once the last
+        row of tiles (which wraps over them) is added, so rows are only final once all
+        tiles are.'''
+
+        if idx == len(self.positions[0])*len(self.positions[1]) - 1:
+            return self.merged.shape[1]
+        return 0
+
+
+def tiles_merge_seamless(tiles, stride_size, img_size, positions, dtype=np.float64):
+    '''Same as tiles_merge, for the tiles of tiles_split_seamless.'''
+
+    merger = SeamlessTilesMerger(tiles[0].shape[1:3], stride_size, img_size, positions,
+                                 dtype=dtype)
+    for idx, tile in enumerate(tiles):
+        merger.add(idx, tile)
+    return merger.result()
+
+
+def downscale(img, factor):
+    '''Downscales a C,H,W image by an integer factor (averaging factor x factor blocks),
+    wrapping the image to a multiple of factor first.'''
+
+    _, img_h, img_w = img.shape
+    img = pad(img, 0, -img_w % factor, 0, -img_h % factor)
+    c, h, w = img.shape
+    return img.reshape(c, h//factor, factor, w//factor, factor).mean(axis=(2, 4))
+
+
+def upsample(img, factor, img_size):
+    '''Bilinear upsampling of a C,H,W image by an integer factor, cropped to img_size
+    (H,W).'''
+
+    def coords(size_out, size_in):
+        x = np.clip((np.arange(size_out)+0.5) / factor - 0.5, 0, size_in-1)
+        x0 = np.floor(x).astype(int)
+        return x0, np.minimum(x0+1, size_in-1), (x-x0).astype(img.dtype)
+
+    y0, y1, ty = coords(img_size[0], img.shape[1])
+    x0, x1, tx = coords(img_size[1], img.shape[2])
+    rows = img[:, y0]*(1-ty)[:, None] + img[:, y1]*ty[:, None]
+    return rows[:, :, x0]*(1-tx) + rows[:, :, x1]*tx
+
+
 def normalize(img):
     'Normalize each pixel to unit vector.'
 
-    img = img-0.5
-    img = img / np.sqrt(np.sum(img*img, axis=0, keepdims=True))
-    return (img*0.5)+0.5
+    # Single copy (in the precision img-0.5 would have), normalized in place
+    return normalize_inplace(np.array(img, dtype=np.result_type(img, 0.5)))
+
+
+def normalize_inplace(img, chunk_rows=64):
+    '''Same as normalize, but computed in place by chunks of rows to avoid full size
+    temporaries.'''
+
+    for row in range(0, img.shape[1], chunk_rows):
+        chunk = img[:, row:row+chunk_rows]
+        chunk -= 0.5
+        chunk /= np.sqrt(np.sum(chunk*chunk, axis=0, keepdims=True))
+        chunk *= 0.5
+        chunk += 0.5
+    return img
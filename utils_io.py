@@ -0,0 +1,253 @@
+import io
+import os
+import struct
+import zlib
+import numpy as np
+
+try:
+    from . import utils_postprocess
+except ImportError:
+    # Cannot use . import when using as CLI
+    import utils_postprocess
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+NPY_SIGNATURE = b"\x93NUMPY"
+
+# PNG color type of each channels count & the other way around
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+PNG_CHANNELS = {0: 1, 4: 2, 2: 3, 6: 4}
+
+# Output formats supporting 16 bits
+BIT_DEPTH_16_EXTENSIONS = [".png", ".tif", ".tiff"]
+
+
+def to_float(img):
+    """Converts a decoded H,W,C (or H,W) image to a C,H,W float32 array in [0,1], in a
+    single pass. Integer images are scaled from their full range (8 or 16 bits), float
+    ones are only transposed (as a view, without copy). Grayscale images are expanded
+    to 3 channels without copy."""
+
+    if img.ndim == 2:
+        img = img[:, :, np.newaxis]
+    if np.issubdtype(img.dtype, np.floating):
+        out = np.moveaxis(img, -1, 0)
+    else:
+        max_value = np.iinfo(img.dtype).max
+        out = np.empty((img.shape[2], img.shape[0], img.shape[1]), dtype=np.float32)
+        for channel in range(img.shape[2]):
+            np.divide(img[:, :, channel], max_value, out=out[channel], dtype=np.float32)
+
+    # Grayscale (& alpha)
+    if out.shape[0] < 3:
+        out = np.broadcast_to(out[0:1], (3,) + out.shape[1:])
+    return out
+
+
+def read_image(path):
+    """Reads an image file (or encoded image bytes) as a C,H,W float32 numpy array in
+    [0,1]. 8 & 16 bits images are supported. .npy files (H,W,C arrays, floats in [0,1]
+    or integers) are memory mapped, float ones being returned as a view without copy."""
+
+    import imageio.v3 as iio
+
+    if isinstance(path, (bytes, bytearray)):
+        header = bytes(path[:32])
+    else:
+        with open(path, "rb") as file:
+            header = file.read(32)
+
+    if header.startswith(NPY_SIGNATURE):
+        if isinstance(path, (bytes, bytearray)):
+            return to_float(np.load(io.BytesIO(path)))
+        return to_float(np.load(path, mmap_mode="r"))
+
+    # imageio (Pillow) reduces 16 bits color PNGs to 8 bits
+    if header.startswith(PNG_SIGNATURE) and len(header) > 24 and header[24] == 16:
+        if not isinstance(path, (bytes, bytearray)):
+            with open(path, "rb") as file:
+                path = file.read()
+        return to_float(decode_png16(path))
+
+    return to_float(iio.imread(path))
+
+
+def write_image(path, img, extension=None, bit_depth=8):
+    """Writes a C,H,W numpy array in [0,1] to an image file, as 8 or 16 bits integers
+    ('bit_depth', 16 bits only for PNG & TIFF) or as a float32 H,W,C array for .npy
+    files. If 'path' is '<bytes>', the encoded image (in the format given by
+    'extension') is returned instead."""
+
+    import imageio.v3 as iio
+
+    if extension is None:
+        extension = os.path.splitext(path)[1]
+    extension = extension.lower()
+
+    if extension == ".npy":
+        return write_npy(path, img)
+
+    if bit_depth == 16:
+        if extension not in BIT_DEPTH_16_EXTENSIONS:
+            raise ValueError(f"16 bits output is not supported for '{extension}' images")
+        pixels = utils_postprocess.quantize(img, np.uint16)
+        # Pillow cannot write 16 bits color PNGs
+        if extension == ".png":
+            data = encode_png16(pixels)
+            if path == "<bytes>":
+                return data
+            with open(path, "wb") as file:
+                file.write(data)
+            return None
+        return iio.imwrite(path, pixels, extension=extension)
+
+    return iio.imwrite(path, utils_postprocess.quantize(img), extension=extension)
+
+
+def write_npy(path, img):
+    """Writes a C,H,W numpy array to a .npy file as a float32 H,W,C array, through a
+    memory map (filled in a single pass)."""
+
+    channels, height, width = img.shape
+    if path == "<bytes>":
+        buffer = io.BytesIO()
+        np.save(buffer, np.moveaxis(img, 0, -1).astype(np.float32))
+        return buffer.getvalue()
+    out = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=(height, width, channels)
+    )
+    out[...] = np.moveaxis(img, 0, -1)
+    out.flush()
+    del out
+    return None
+
+
+def png_chunk(kind, data):
+    return (
+        struct.pack(">I", len(data)) + kind + data
+        + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+    )
+
+
+def encode_png16(img):
+    """Encodes a H,W,C uint16 array to 16 bits PNG bytes. Rows use the 'Sub' filter,
+    filtered & compressed by chunks of rows."""
+
+    height, width, channels = img.shape
+    pixel_size = channels * 2
+    header = struct.pack(">IIBBBBB", width, height, 16, PNG_COLOR_TYPES[channels], 0, 0, 0)
+
+    compressor = zlib.compressobj(6)
+    idat = []
+    rows = max(1, utils_postprocess.CHUNK_SIZE // (width * pixel_size))
+    for start in range(0, height, rows):
+        # Big endian samples, each row starting with its filter type
+        chunk = img[start:start+rows]
+        raw = np.empty((len(chunk), 1 + width * pixel_size), dtype=np.uint8)
+        raw[:, 1:].view(">u2").reshape(chunk.shape)[...] = chunk
+        filtered = raw.copy()
+        filtered[:, 0] = 1
+        np.subtract(
+            raw[:, 1+pixel_size:], raw[:, 1:-pixel_size], out=filtered[:, 1+pixel_size:]
+        )
+        idat.append(compressor.compress(filtered))
+    idat.append(compressor.flush())
+
+    return (
+        PNG_SIGNATURE + png_chunk(b"IHDR", header)
+        + png_chunk(b"IDAT", b"".join(idat)) + png_chunk(b"IEND", b"")
+    )
+
+
+def decode_png16(data):
+    """Decodes 16 bits PNG bytes to a H,W,C uint16 array."""
+
+    pos = len(PNG_SIGNATURE)
+    idat = []
+    while pos < len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos+8])
+        body = data[pos+8:pos+8+length]
+        if kind == b"IHDR":
+            width, height, _, color_type, _, _, interlace = struct.unpack(">IIBBBBB", body)
+        elif kind == b"IDAT":
+            idat.append(body)
+        elif kind == b"IEND":
+            break
+        pos += length + 12
+    if interlace:
+        raise ValueError("interlaced 16 bits PNGs are not supported")
+
+    channels = PNG_CHANNELS[color_type]
+    raw = np.frombuffer(zlib.decompress(b"".join(idat)), dtype=np.uint8)
+    raw = raw.reshape(height, 1 + width * channels * 2)
+    pixels = png_unfilter(raw[:, 1:], raw[:, 0], channels * 2)
+    return pixels.view(">u2").reshape(height, width, channels).astype(np.uint16)
+
+
+def png_unfilter(filtered, filters, pixel_size):
+    """Reverts the PNG filters of each row of 'filtered' (H, row bytes), 'filters' being
+    the filter type of each row."""
+
+    height, row_size = filtered.shape
+    if np.any(filters >= 3):
+        return png_unfilter_wavefront(filtered, filters, pixel_size)
+
+    # None, Sub & Up filters only depend on the previous row, rows are reverted one at a
+    # time
+    out = np.empty_like(filtered)
+    previous = np.zeros(row_size, dtype=np.uint8)
+    for row in range(height):
+        if filters[row] == 0:
+            out[row] = filtered[row]
+        elif filters[row] == 1:
+            pixels = filtered[row].reshape(-1, pixel_size)
+            np.cumsum(pixels, axis=0, dtype=np.uint8, out=out[row].reshape(-1, pixel_size))
+        else:
+            np.add(filtered[row], previous, out=out[row])
+        previous = out[row]
+    return out
+
+
+def png_unfilter_wavefront(filtered, filters, pixel_size):
+    """Same as png_unfilter, for images using the Average or Paeth filters. Each pixel
+    depends on its left, up & up-left neighbours, so pixels are reverted one
+    anti-diagonal at a time, all pixels of an anti-diagonal at once. Pixels are stored
+    skewed (pixel x of row r at [r+x+2, r+1]) so that each anti-diagonal is contiguous,
+    with zeros for the pixels before the first row & column."""
+
+    height = filtered.shape[0]
+    width = filtered.shape[1] // pixel_size
+    filtered = filtered.reshape(height, width, pixel_size)
+
+    def skewed_view(skewed):
+        return np.lib.stride_tricks.as_strided(
+            skewed[2:, 1:],
+            shape=(height, width, pixel_size),
+            strides=(
+                skewed.strides[0] + skewed.strides[1], skewed.strides[0], skewed.strides[2]
+            ),
+        )
+
+    shape = (height + width + 1, height + 1, pixel_size)
+    skewed_filtered = np.zeros(shape, dtype=np.uint8)
+    skewed_view(skewed_filtered)[...] = filtered
+    skewed = np.zeros(shape, dtype=np.uint8)
+    row_filters = filters.astype(np.int16)[:, np.newaxis]
+
+    for diagonal in range(2, height + width + 1):
+        # Skewed rows of the pixels on this anti-diagonal
+        first, last = max(1, diagonal - width), min(height, diagonal - 1)
+        row_filter = row_filters[first-1:last]
+        a = skewed[diagonal-1, first:last+1].astype(np.int16)
+        b = skewed[diagonal-1, first-1:last].astype(np.int16)
+        c = skewed[diagonal-2, first-1:last].astype(np.int16)
+
+        pa, pb, pc = np.abs(b - c), np.abs(a - c), np.abs(a + b - 2 * c)
+        paeth = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+        predictor = np.select(
+            [row_filter == 1, row_filter == 2, row_filter == 3, row_filter == 4],
+            [a, b, (a + b) >> 1, paeth],
+            0,
+        )
+        skewed[diagonal, first:last+1] = skewed_filtered[diagonal, first:last+1] + predictor
+
+    return skewed_view(skewed).reshape(height, width * pixel_size)
@@ -0,0 +1,61 @@
+import numpy as np
+
+# Size (in bytes) of the chunks of rows processed at once, small enough for each chunk to
+# stay in cache between the fused operations
+CHUNK_SIZE = 1 << 18
+
+
+def chunk_rows(img, chunk_size=CHUNK_SIZE):
+    """Returns the amount of rows of 'img' (C,H,W or H,W) making a chunk of about
+    'chunk_size' bytes."""
+
+    row_size = img.itemsize * img.shape[-1] * (img.shape[0] if img.ndim == 3 else 1)
+    return max(1, chunk_size // row_size)
+
+
+def min_max(img):
+    """Returns the min & max of 'img' (H,W), reading it from memory only once."""
+
+    rows = chunk_rows(img)
+    img_min, img_max = np.inf, -np.inf
+    for start in range(0, img.shape[0], rows):
+        chunk = img[start:start+rows]
+        img_min = min(img_min, chunk.min())
+        img_max = max(img_max, chunk.max())
+    return img_min, img_max
+
+
+def normalize_range(img, out=None):
+    """Normalizes 'img' (H,W) to [0,1] by chunks of rows. Written to 'out' (which can be
+    'img' itself), allocated if None. Same result as (img - min) / (max - min)."""
+
+    img_min, img_max = min_max(img)
+    if out is None:
+        out = np.empty_like(img)
+    rows = chunk_rows(img)
+    for start in range(0, img.shape[0], rows):
+        chunk = out[start:start+rows]
+        np.subtract(img[start:start+rows], img_min, out=chunk)
+        chunk /= img_max - img_min
+    return out
+
+
+def quantize(img, dtype=np.uint8, out=None):
+    """Converts a C,H,W image in [0,1] to a H,W,C image of 'dtype' integers (uint8 or
+    uint16) spanning their full range, clipping values out of [0,1]. Computed by chunks
+    of rows, so the only full size array is the H,W,C output ('out' if given)."""
+
+    channels, height, width = img.shape
+    max_value = np.iinfo(dtype).max
+    if out is None:
+        out = np.empty((height, width, channels), dtype=dtype)
+
+    # Scale in a reused chunk buffer, in the image precision (as a plain conversion does)
+    rows = chunk_rows(img)
+    buffer = np.empty((rows, width, channels), dtype=np.result_type(img.dtype, np.float32))
+    for start in range(0, height, rows):
+        chunk = buffer[:min(rows, height-start)]
+        np.multiply(np.moveaxis(img[:, start:start+rows], 0, -1), max_value, out=chunk)
+        np.clip(chunk, 0, max_value, out=chunk)
+        out[start:start+rows] = chunk
+    return out
@@ -0,0 +1,56 @@
+import json
+import os
+import platform
+
+# Machine profile, loaded on first use
+profile = None
+
+
+def profile_path():
+    """Returns the path of the runtime profile of this machine, written by the autotune
+    command. Can be overridden with the DEEPBUMP_PROFILE environment variable."""
+
+    path = os.environ.get("DEEPBUMP_PROFILE")
+    if path:
+        return path
+    # One file per machine, so that machines sharing a home directory keep their own
+    machine = platform.node() or "default"
+    return os.path.join(os.path.expanduser("~"), ".deepbump", f"profile_{machine}.json")
+
+
+def load_profile():
+    """Returns the machine profile (an empty dict if there is none)."""
+
+    global profile
+    if profile is None:
+        profile = {}
+        path = profile_path()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                profile = json.load(file)
+    return profile
+
+
+def model_profile(model_path):
+    """Returns the tuned settings (batch_size, intra_op_num_threads,
+    inter_op_num_threads) of the model, or an empty dict if the model was not tuned or
+    was tuned with another CPU count."""
+
+    current = load_profile()
+    if current.get("cpu_count") != os.cpu_count():
+        return {}
+    return current.get("models", {}).get(os.path.basename(model_path), {})
+
+
+def save_profile(new_profile):
+    """Writes the machine profile, replacing any previous one atomically."""
+
+    global profile
+    path = profile_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(new_profile, file, indent=2)
+    os.replace(tmp_path, path)
+    profile = new_profile
+    return path